@@ -1,17 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-from io import BytesIO
+import hmac
 import json
+import math
 import time
-import urllib.parse
 import cloudinary
-import cloudinary.api
-import cloudinary.uploader
 import pandas as pd
-from PIL import ExifTags, Image
-import requests
 import streamlit as st
 import streamlit.components.v1 as components
 
+from gallery_core import (
+    ADMIN_TOKEN,
+    COMPRESS_WORKERS,
+    FLUSH_INTERVAL,
+    GALLERY_PAGE_SIZE,
+    JOB_POLL_INTERVAL,
+    MODAL_WIDTH,
+    PERF_SAMPLE_SIZE,
+    THUMBNAIL_LAYOUTS,
+    WATERMARK_MODE,
+    bind_session_metrics,
+    build_thumbnail_img,
+    cached_local_watermarks,
+    combine_summaries,
+    compute_content_hashes,
+    create_share,
+    export_prometheus,
+    fetch_share,
+    flush_changes,
+    format_file_size,
+    get_job_queue,
+    get_perf_metrics,
+    get_shared_gallery,
+    get_thumbnail_url,
+    get_watermark_filler,
+    make_share_token,
+    month_year_table,
+    perf_timer,
+    record_changes,
+    resolve_watermark_layer,
+    run_backfill_job,
+    run_delete_job,
+    run_local_watermark_job,
+    run_tag_job,
+    run_upload_job,
+    run_watermark_job,
+    sort_photos,
+)
+
 # --- 網頁配置 ---
 st.set_page_config(page_title="雲端圖庫 Ultimate", layout="wide", page_icon="🖼️")
 
@@ -24,8 +60,6 @@ if "cloudinary" in st.secrets:
         secure=True,
     )
 
-DB_FILENAME = "photo_db_v2.json"
-
 
 # --- 2. 專屬 CSS 魔法 (優化版：寬鬆輕盈的滿版菱形防護網) ---
 def inject_custom_css():
@@ -74,6 +108,17 @@ def inject_custom_css():
         height: auto;
         display: block;
     }
+    /* 延遲載入縮圖：載入前以模糊小圖當底，並先保留 4:3 版位讓 lazy loading 生效 */
+    .lazy-thumb {
+        width: 100%;
+        height: auto;
+        aspect-ratio: auto 4 / 3;
+        display: block;
+        border-radius: 5px;
+        background-size: cover;
+        background-position: center;
+        background-repeat: no-repeat;
+    }
     .watermark-overlay {
         position: absolute;
         top: 0;
@@ -136,157 +181,174 @@ def inject_custom_css():
 inject_custom_css()
 
 
-# --- 3. 核心功能函數 ---
-def get_thumbnail_url(url, width=800):
-    """利用 Cloudinary 動態轉換取得輕量縮圖"""
-    if "/upload/" in url:
-        return url.replace("/upload/", f"/upload/w_{width},c_scale,q_auto,f_auto/")
-    return url
-
-
-def render_watermarked_image(image_url, watermark=False):
-    """根據是否開啟浮水印，渲染對應的 HTML 圖片結構"""
+# --- 3. 介面輔助函數 (核心功能在 gallery_core.py) ---
+def render_watermarked_image(
+    image_url, watermark=False, layout="share", alt="", watermark_layer=None
+):
+    """
+    根據是否開啟浮水印，渲染對應的 HTML 圖片結構 (image_url 為原圖網址)。
+    有 watermark_layer 時只輸出一個疊好浮水印的 <img>，否則在縮圖上蓋 CSS 網格。
+    """
+    if watermark and watermark_layer and "/upload/" in image_url:
+        img_tag = build_thumbnail_img(
+            image_url, layout=layout, alt=alt, watermark_layer=watermark_layer
+        )
+        st.markdown(img_tag, unsafe_allow_html=True)
+        return
+    img_tag = build_thumbnail_img(image_url, layout=layout, alt=alt)
     if watermark:
         html_code = f"""
         <div class="watermark-container">
-            <img src="{image_url}" style="width:100%; border-radius: 5px;">
+            {img_tag}
             <div class="watermark-overlay" title="SAMPLE WATERMARK"></div>
         </div>
         """
         st.markdown(html_code, unsafe_allow_html=True)
     else:
-        st.image(image_url, use_container_width=True)
+        st.markdown(img_tag, unsafe_allow_html=True)
+
+
+def hash_uploaded_files(files):
+    """計算待上傳檔案的雜湊 (以 file_id 快取，重新執行頁面時不重算)"""
+    cache = st.session_state.setdefault("upload_hashes", {})
+    keys = [getattr(f, "file_id", None) or f"{f.name}:{f.size}" for f in files]
+    missing = [(k, f) for k, f in zip(keys, files) if k not in cache]
+    if missing:
+        with ThreadPoolExecutor(max_workers=COMPRESS_WORKERS) as pool:
+            hashes = pool.map(compute_content_hashes, [f.getvalue() for k, f in missing])
+            for (k, f), h in zip(missing, hashes):
+                cache[k] = h
+    return [cache[k] for k in keys]
+
+
+def submit_job(label, func, *args):
+    """提交背景工作並記在本工作階段，完成時據以顯示結果"""
+    job_id = get_job_queue().submit(label, func, *args)
+    st.session_state.setdefault("my_job_ids", set()).add(job_id)
+    return job_id
+
+
+def render_finished_job(job):
+    result = job["result"] or {}
+    if job["status"] == "failed":
+        st.error(f"❌ {job['label']}失敗：{job['error']}")
+    elif result.get("errors"):
+        st.warning(
+            f"⚠️ {result['summary']}，但有 {len(result['errors'])} 項失敗：\n"
+            + "\n".join(f"- {e}" for e in result["errors"][:10])
+            + ("\n- ..." if len(result["errors"]) > 10 else "")
+        )
+    else:
+        st.success(f"✅ {result.get('summary', job['label'] + '完成')}")
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def render_active_jobs():
+    """工作進行中時定期更新進度，全部結束後重新執行整頁以載入最新圖庫"""
+    jobs = get_job_queue().snapshot()
+    active = [j for j in jobs if j["finished_at"] is None]
+    if not active:
+        st.rerun(scope="app")
+    for job in active:
+        if job["status"] == "queued":
+            st.caption(f"🕒 {job['label']}：等待中")
+            continue
+        fraction = job["done"] / job["total"] if job["total"] else 0.0
+        st.progress(
+            fraction,
+            text=f"{job['label']} {job['done']}/{job['total']} {job['message']}",
+        )
 
 
-def format_file_size(size_in_bytes):
-    if not size_in_bytes:
-        return "未知"
-    for unit in ["B", "KB", "MB", "GB"]:
-        if size_in_bytes < 1024:
-            return f"{size_in_bytes:.1f} {unit}"
-        size_in_bytes /= 1024
-    return f"{size_in_bytes:.1f} GB"
+def render_job_panel():
+    """側邊欄的背景工作面板"""
+    job_queue = get_job_queue()
+    jobs = job_queue.snapshot()
+    if not jobs:
+        return
 
+    # 本工作階段提交的刪除工作若有失敗項目，重新選取以便再試一次
+    my_job_ids = st.session_state.setdefault("my_job_ids", set())
+    for job in jobs:
+        if job["id"] in my_job_ids and job["finished_at"]:
+            my_job_ids.discard(job["id"])
+            retry_ids = (job["result"] or {}).get("retry_ids")
+            if retry_ids:
+                get_selected_ids().update(pid for pid in retry_ids if pid in photo_repo.by_id)
 
-def compress_image(image_file):
-    try:
-        img = Image.open(image_file)
-        try:
-            exif = img._getexif()
-            if exif is not None:
-                orientation_key = next(
-                    (k for k, v in ExifTags.TAGS.items() if v == "Orientation"),
-                    None,
-                )
-                if orientation_key and orientation_key in exif:
-                    orientation = exif[orientation_key]
-                    if orientation == 3:
-                        img = img.rotate(180, expand=True)
-                    elif orientation == 6:
-                        img = img.rotate(270, expand=True)
-                    elif orientation == 8:
-                        img = img.rotate(90, expand=True)
-        except Exception:
-            pass
-
-        max_width = 1920
-        if img.width > max_width:
-            ratio = max_width / img.width
-            new_height = int(img.height * ratio)
-            img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-
-        if img.mode in ("RGBA", "P"):
-            img = img.convert("RGB")
-
-        output_buffer = BytesIO()
-        img.save(output_buffer, format="JPEG", quality=80, optimize=True)
-        output_buffer.seek(0)
-        return output_buffer
-    except Exception as e:
-        print(f"壓縮失敗: {e}")
-        image_file.seek(0)
-        return image_file
-
-
-def load_db():
-    try:
-        url, options = cloudinary.utils.cloudinary_url(
-            DB_FILENAME, resource_type="raw"
+    st.divider()
+    st.header("⏳ 背景工作")
+    if job_queue.has_active():
+        render_active_jobs()
+    finished = [j for j in jobs if j["finished_at"]]
+    for job in reversed(finished):
+        render_finished_job(job)
+    if finished:
+        st.button(
+            "🧹 清除已完成的工作",
+            use_container_width=True,
+            on_click=job_queue.dismiss_finished,
         )
-        no_cache_url = f"{url}?t={int(time.time())}"
-        response = requests.get(no_cache_url, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            for item in data:
-                item["date"] = datetime.datetime.strptime(
-                    item["date_str"], "%Y-%m-%d"
-                ).date()
-                if "album" not in item:
-                    item["album"] = "未分類"
-                if "size" not in item:
-                    item["size"] = 0
-            return data
-        else:
-            return []
-    except Exception:
-        return []
 
 
-def save_db(data):
-    save_list = []
-    for item in data:
-        save_list.append(
-            {
-                "public_id": item["public_id"],
-                "url": item["url"],
-                "name": item["name"],
-                "date_str": item["date"].strftime("%Y-%m-%d"),
-                "tags": item["tags"],
-                "album": item.get("album", "未分類"),
-                "size": item.get("size", 0),
-            }
-        )
-    json_str = json.dumps(save_list, ensure_ascii=False, indent=2)
-    try:
-        cloudinary.uploader.upload(
-            BytesIO(json_str.encode("utf-8")),
-            public_id=DB_FILENAME,
-            resource_type="raw",
-            overwrite=True,
-            invalidate=True,
-        )
-    except Exception as e:
-        st.error(f"資料庫同步雲端失敗: {e}")
+def request_clear_selections():
+    st.session_state["need_clear_selections"] = True
 
 
-def delete_image_from_cloud(public_id):
-    try:
-        cloudinary.uploader.destroy(public_id)
-    except Exception as e:
-        print(f"刪除圖片失敗 ({public_id}): {e}")
+def get_selected_ids():
+    """選取狀態獨立存放，切換分頁後不在畫面上的照片仍保持選取"""
+    return st.session_state.setdefault("selected_ids", set())
 
 
-def request_clear_selections():
-    st.session_state["need_clear_selections"] = True
+def toggle_photo_selection(public_id):
+    if st.session_state.get(f"sel_{public_id}"):
+        get_selected_ids().add(public_id)
+    else:
+        get_selected_ids().discard(public_id)
+
+
+def change_gallery_page(delta, total_pages):
+    page = st.session_state.get("gallery_page", 1) + delta
+    st.session_state["gallery_page"] = min(max(page, 1), total_pages)
 
 
 # --- 4. 應用程式主邏輯 ---
 
+# 本次執行期間的效能統計同時記入本 session 與程序層級
+bind_session_metrics()
+
 if st.session_state.get("need_clear_selections", False):
+    get_selected_ids().clear()
     for key in list(st.session_state.keys()):
         if key.startswith("sel_"):
             st.session_state[key] = False
     st.session_state["need_clear_selections"] = False
 
-if "gallery" not in st.session_state:
+# 所有 session 共用同一份圖庫快取，僅在雲端版本變更時才重新下載
+shared_gallery = get_shared_gallery()
+if not shared_gallery.loaded:
     with st.spinner("載入雲端資料庫..."):
-        st.session_state.gallery = load_db()
+        shared_gallery.sync()
+else:
+    shared_gallery.sync()
+if not shared_gallery.loaded:
+    # 尚未成功載入過 (雲端讀取失敗)，下次重新執行時再試
+    st.error("無法讀取雲端資料庫，請稍後重新整理頁面。")
+    st.stop()
+photo_repo = shared_gallery.repo
+
+
+def load_gallery_albums(albums=None):
+    """確保指定相簿 (None 為全部) 的分片已載入，需要下載時顯示讀取中"""
+    if not shared_gallery.has_albums(albums):
+        with st.spinner("載入雲端資料庫..."):
+            shared_gallery.ensure_albums(albums)
 
 
 # === 📸 照片詳情 Modal ===
 @st.dialog("📸 照片詳情", width="large")
 def show_large_image(photo):
-    st.image(photo["url"], use_container_width=True)
+    st.image(get_thumbnail_url(photo["url"], width=MODAL_WIDTH), use_container_width=True)
     st.divider()
 
     # --- ✏️ 1. 修改檔名 ---
@@ -294,11 +356,9 @@ def show_large_image(photo):
     new_name = st.text_input("檔名", value=photo["name"], key=f"edit_name_modal_{photo['public_id']}")
     if st.button("💾 儲存檔名", key=f"btn_name_modal_{photo['public_id']}", use_container_width=True):
         if new_name.strip():
-            for origin in st.session_state.gallery:
-                if origin["public_id"] == photo["public_id"]:
-                    origin["name"] = new_name.strip()
-                    break
-            save_db(st.session_state.gallery)
+            record_changes(
+                [photo_repo.update(photo["public_id"], name=new_name.strip())]
+            )
             st.toast("✅ 檔名已成功修改！")
             time.sleep(0.5)
             st.rerun()
@@ -316,11 +376,9 @@ def show_large_image(photo):
         key=f"edit_tags_modal_{photo['public_id']}"
     )
     if st.button("💾 儲存標籤", key=f"btn_tags_modal_{photo['public_id']}", use_container_width=True, type="primary"):
-        for origin in st.session_state.gallery:
-            if origin["public_id"] == photo["public_id"]:
-                origin["tags"] = selected_tags_modal
-                break
-        save_db(st.session_state.gallery)
+        record_changes(
+            [photo_repo.update(photo["public_id"], tags=selected_tags_modal)]
+        )
         st.toast("✅ 標籤已成功更新！")
         time.sleep(0.5)
         st.rerun()
@@ -342,13 +400,32 @@ def show_large_image(photo):
         unsafe_allow_html=True,
     )
 
+    st.divider()
+
+    # --- 🔎 3. 相似照片 (例如同一張作品的線稿 / 彩色版本) ---
+    st.subheader("🔎 相似照片")
+    if not photo.get("phash"):
+        st.caption("此照片尚未建立相似度雜湊，可在側邊欄「🛠️ 維護工具」補算。")
+    elif st.button("🔎 尋找相似照片", key=f"btn_similar_{photo['public_id']}", use_container_width=True):
+        load_gallery_albums()
+        similar = photo_repo.find_similar(photo["public_id"])
+        if not similar:
+            st.info("找不到相似的照片。")
+        else:
+            cols = st.columns(4)
+            for i, (distance, other) in enumerate(similar):
+                with cols[i % 4]:
+                    st.image(get_thumbnail_url(other["url"], width=200), use_container_width=True)
+                    similarity = round(100 * (64 - distance) / 64)
+                    st.caption(f"{other['name']}\n📂 {other['album']} | 相似度 {similarity}%")
+
 
 # =========================================================
 # 🔗 [分享頁面]（鎖定：不可放大、不可下載圖片、防右鍵、菱形網格保護網）
 # =========================================================
 query_params = st.query_params
 
-if "share" in query_params:
+if "s" in query_params or "share" in query_params:
     st.title("🖼️ 專屬分享相簿")
     st.caption("您正透過專屬分享連結瀏覽特定相片內容")
 
@@ -369,20 +446,51 @@ if "share" in query_params:
         unsafe_allow_html=True,
     )
 
-    raw_share = query_params["share"]
-    shared_ids = [pid.strip() for pid in raw_share.split(",") if pid.strip()]
-
-    # 檢查網址是否有勾選啟用浮水印 (&wm=1)
-    use_watermark = query_params.get("wm", "0") == "1"
-
-    shared_photos = [
-        p for p in st.session_state.gallery if p["public_id"] in shared_ids
-    ]
+    if "s" in query_params:
+        # 短代碼連結：照片 ID、所在相簿與浮水印設定記錄在雲端的分享小檔
+        try:
+            share = fetch_share(query_params["s"])
+        except Exception as e:
+            print(f"讀取分享內容失敗: {e}")
+            share = {"ids": [], "albums": [], "wm": False}
+        shared_ids = share["ids"]
+        share_albums = share["albums"]
+        use_watermark = share["wm"]
+    else:
+        # 舊版連結：網址直接列出照片 ID，可能附帶相簿提示 (&a=) 與浮水印開關 (&wm=1)
+        raw_share = query_params["share"]
+        shared_ids = [pid.strip() for pid in raw_share.split(",") if pid.strip()]
+        share_albums = query_params.get_all("a") or None
+        use_watermark = query_params.get("wm", "0") == "1"
+
+    # 只載入分享照片所在相簿的分片，再依 ID 直接取出 (不掃描整個圖庫)
+    shared_photos = []
+    if shared_ids:
+        load_gallery_albums(share_albums)
+        shared_photos = photo_repo.select(shared_ids)
+        if len(shared_photos) < len(shared_ids) and share_albums is not None:
+            # 照片可能已移到其他相簿，找不齊時再載入其餘分片
+            load_gallery_albums()
+            shared_photos = photo_repo.select(shared_ids)
+
+    # 浮水印直接疊在 Cloudinary 衍生圖上 (CDN 快取)，或在本機合成 (磁碟快取)；
+    # 兩者都無法使用時退回 CSS 網格
+    watermark_layer = resolve_watermark_layer() if use_watermark else None
+    local_watermarks = {}
+    if use_watermark and WATERMARK_MODE == "local" and shared_photos:
+        # 只取用磁碟快取中已合成的圖；其餘在背景合成 (之後開啟時改用合成圖)，
+        # 這次先以延遲載入的縮圖 + CSS 網格顯示，不讓頁面等待下載與合成
+        share_width = THUMBNAIL_LAYOUTS["share"]["fallback_width"]
+        local_watermarks = cached_local_watermarks(shared_photos, share_width)
+        get_watermark_filler().submit(
+            [p for p in shared_photos if p["public_id"] not in local_watermarks],
+            share_width,
+        )
 
     if not shared_photos:
         st.error("⚠️ 找不到分享的照片，連結可能已失效或圖片已被刪除。")
     else:
-        wm_status = " (已保護：已載入菱形 SAMPLE 浮水印)" if use_watermark else ""
+        wm_status = " (已加上菱形 SAMPLE 浮水印)" if use_watermark else ""
         st.success(f"📷 共有 {len(shared_photos)} 張分享的作品{wm_status}")
         st.divider()
 
@@ -393,11 +501,20 @@ if "share" in query_params:
                     photo = shared_photos[i + j]
                     with cols[j]:
                         with st.container(border=True):
-                            # 呼叫渲染函式帶入輕量菱形浮水印圖層
-                            render_watermarked_image(
-                                get_thumbnail_url(photo["url"], width=800), 
-                                watermark=use_watermark
-                            )
+                            if local_watermarks.get(photo["public_id"]):
+                                st.image(
+                                    local_watermarks[photo["public_id"]],
+                                    use_container_width=True,
+                                )
+                            else:
+                                # 呼叫渲染函式帶入菱形 SAMPLE 浮水印
+                                render_watermarked_image(
+                                    photo["url"],
+                                    watermark=use_watermark,
+                                    layout="share",
+                                    alt=photo["name"],
+                                    watermark_layer=watermark_layer,
+                                )
                             st.caption(f"📄 {photo['name']}")
 
     st.markdown('<div id="bottom-anchor"></div>', unsafe_allow_html=True)
@@ -408,11 +525,6 @@ if "share" in query_params:
 # =========================================================
 st.title("☁️ 雲端圖庫 (電腦/手機 雙重適應版)")
 
-existing_albums = sorted(
-    list(set([item["album"] for item in st.session_state.gallery]))
-)
-if "未分類" not in existing_albums:
-    existing_albums.append("未分類")
 
 # === 預設標籤與指定排序設定 ===
 DING_TAGS = [
@@ -433,20 +545,40 @@ RING_TAGS = [
 
 DEFAULT_TAGS = DING_TAGS + RING_TAGS
 
-db_existing_tags = [
-    tag for item in st.session_state.gallery for tag in item["tags"]
-]
-extra_tags = [tag for tag in db_existing_tags if tag not in DEFAULT_TAGS]
-ALL_TAG_OPTIONS = DEFAULT_TAGS + sorted(list(set(extra_tags)))
+# 相簿 / 標籤 / 年份選單只在圖庫的相關內容變更時重新計算
+gallery_options = shared_gallery.option_lists(DEFAULT_TAGS)
+existing_albums = gallery_options["albums"]
+ALL_TAG_OPTIONS = gallery_options["tags"]
 
 # === 側邊欄 ===
 with st.sidebar:
     st.header("功能選單")
+    page_options = ["📸 相簿瀏覽", "📊 數據統計"]
+    if ADMIN_TOKEN and hmac.compare_digest(
+        str(query_params.get("admin", "")).encode("utf-8"),
+        str(ADMIN_TOKEN).encode("utf-8"),
+    ):
+        page_options.append("🩺 效能監控")
     page_mode = st.radio(
         "前往頁面",
-        ["📸 相簿瀏覽", "📊 數據統計"],
+        page_options,
         label_visibility="collapsed",
     )
+
+    # --- 雲端同步狀態 (延遲合併寫入) ---
+    if shared_gallery.pending_ops:
+        st.caption(
+            f"🟡 有 {len(shared_gallery.pending_ops)} 項變更尚未同步到雲端"
+            f"（{FLUSH_INTERVAL:g} 秒內自動同步）"
+        )
+        if st.button("☁️ 立即同步", use_container_width=True):
+            if flush_changes():
+                st.toast("☁️ 已同步到雲端")
+                st.rerun()
+            else:
+                st.error("同步失敗，稍後將自動重試。")
+    else:
+        st.caption("🟢 所有變更皆已同步")
     st.divider()
 
     st.header("📂 上傳作品")
@@ -463,13 +595,28 @@ with st.sidebar:
     )
 
     if uploaded_files:
-        existing_names = [p["name"] for p in st.session_state.gallery]
-        duplicates = [
-            f.name for f in uploaded_files if f.name in existing_names
-        ]
+        # 重複檢查需要比對整個圖庫
+        load_gallery_albums()
+        # 在壓縮 / 上傳之前先以雜湊比對，找出圖庫中已有的或同批重複的檔案
+        upload_hashes = hash_uploaded_files(uploaded_files)
+        duplicates = []
+        duplicate_notes = []
+        batch_seen = {}
+        for f, (sha256, phash) in zip(uploaded_files, upload_hashes):
+            match = photo_repo.find_duplicate(f.name, sha256, phash)
+            if match:
+                reason, existing = match
+                duplicates.append(f)
+                duplicate_notes.append(f"{f.name}（{reason}：{existing['name']}）")
+            elif sha256 in batch_seen:
+                duplicates.append(f)
+                duplicate_notes.append(f"{f.name}（與本批 {batch_seen[sha256]} 相同）")
+            else:
+                batch_seen[sha256] = f.name
+        duplicate_ids = {id(f) for f in duplicates}
 
         if duplicates:
-            st.warning(f"⚠️ 發現重複檔名：\n{', '.join(duplicates)}")
+            st.warning("⚠️ 發現重複檔案：\n" + "\n".join(f"- {n}" for n in duplicate_notes))
             upload_mode = st.radio(
                 "對重複檔案的操作：",
                 ["略過重複檔案 (建議)", "強制全部上傳"],
@@ -483,58 +630,46 @@ with st.sidebar:
             else:
                 if duplicates and upload_mode == "略過重複檔案 (建議)":
                     final_files = [
-                        f
-                        for f in uploaded_files
-                        if f.name not in existing_names
+                        f for f in uploaded_files if id(f) not in duplicate_ids
                     ]
                 else:
                     final_files = uploaded_files
+                file_hashes = {
+                    id(f): h for f, h in zip(uploaded_files, upload_hashes)
+                }
 
                 if not final_files:
                     st.info("💡 所有檔案皆已存在圖庫中，無新檔案上傳。")
                 else:
-                    progress = st.progress(0)
-                    status_text = st.empty()
-
-                    for i, f in enumerate(final_files):
-                        status_text.text(
-                            f"處理中 {i+1}/{len(final_files)}：{f.name} (壓縮上傳中...)"
-                        )
-                        try:
-                            compressed_file = compress_image(f)
-                            file_size_bytes = (
-                                compressed_file.getbuffer().nbytes
-                            )
-                            res = cloudinary.uploader.upload(compressed_file)
-
-                            try:
-                                d = datetime.datetime.strptime(
-                                    f.name[:8], "%Y%m%d"
-                                ).date()
-                            except Exception:
-                                d = datetime.date.today()
-
-                            st.session_state.gallery.append(
-                                {
-                                    "public_id": res["public_id"],
-                                    "url": res["secure_url"],
-                                    "name": f.name,
-                                    "date": d,
-                                    "tags": [],
-                                    "album": current_album,
-                                    "size": file_size_bytes,
-                                }
-                            )
-                        except Exception as e:
-                            st.error(f"❌ {f.name} 上傳失敗: {e}")
+                    items = [
+                        {
+                            "name": f.name,
+                            "data": f.getvalue(),
+                            "sha256": file_hashes[id(f)][0],
+                            "phash": file_hashes[id(f)][1],
+                        }
+                        for f in final_files
+                    ]
+                    submit_job(
+                        f"上傳 {len(items)} 張照片", run_upload_job, items, current_album
+                    )
+                    st.rerun()
 
-                        progress.progress((i + 1) / len(final_files))
+    # --- 🛠️ 維護工具：替舊照片補算相似度雜湊 ---
+    if photo_repo.missing_phash:
+        st.divider()
+        with st.expander("🛠️ 維護工具"):
+            st.caption(
+                f"有 {len(photo_repo.missing_phash)} 張照片尚未建立相似度雜湊"
+                "（用於重複檢查與相似照片搜尋）。"
+            )
+            if st.button("🧮 補算相似度雜湊", use_container_width=True):
+                submit_job(
+                    "補算相似度雜湊", run_backfill_job, sorted(photo_repo.missing_phash)
+                )
+                st.rerun()
 
-                    status_text.text("儲存更新資料庫...")
-                    save_db(st.session_state.gallery)
-                    st.success("上傳完成！")
-                    time.sleep(1)
-                    st.rerun()
+    render_job_panel()
 
 # === 頁面分流 ===
 
@@ -574,13 +709,7 @@ if page_mode == "📸 相簿瀏覽":
                 index=0,
             )
         with f_c5:
-            all_years = sorted(
-                list(
-                    set([p["date"].year for p in st.session_state.gallery])
-                ),
-                reverse=True,
-            )
-            filter_year = st.selectbox("📅 年份", ["全部"] + all_years)
+            filter_year = st.selectbox("📅 年份", ["全部"] + gallery_options["years"])
 
         with f_c6:
             all_months = list(range(1, 13))
@@ -590,41 +719,18 @@ if page_mode == "📸 相簿瀏覽":
                 default=all_months,
             )
 
-    filtered_photos = []
-    for p in st.session_state.gallery:
-        match_album = (filter_album == "全部") or (p["album"] == filter_album)
-        match_year = (filter_year == "全部") or (p["date"].year == filter_year)
-
-        if not filter_months:
-            match_month = True
-        else:
-            match_month = p["date"].month in filter_months
-
-        if show_untagged:
-            match_tags = len(p["tags"]) == 0
-        else:
-            match_tags = True
-            if filter_tags:
-                match_tags = all(tag in p["tags"] for tag in filter_tags)
-            if match_tags and exclude_tags:
-                if any(tag in exclude_tags for tag in p["tags"]):
-                    match_tags = False
-
-        if match_album and match_year and match_month and match_tags:
-            filtered_photos.append(p)
-
-    if sort_option == "日期 (舊→新)":
-        filtered_photos.sort(key=lambda x: x["date"])
-    elif sort_option == "日期 (新→舊)":
-        filtered_photos.sort(key=lambda x: x["date"], reverse=True)
-    elif sort_option == "檔名 (A→Z)":
-        filtered_photos.sort(key=lambda x: x["name"])
-    elif sort_option == "檔名 (Z→A)":
-        filtered_photos.sort(key=lambda x: x["name"], reverse=True)
-    elif sort_option == "標籤 (A→Z)":
-        filtered_photos.sort(
-            key=lambda x: x["tags"][0] if x["tags"] else "zzzz"
+    # 篩選單一相簿時只需下載該相簿的分片
+    load_gallery_albums(None if filter_album == "全部" else [filter_album])
+    with perf_timer("page.filter_sort"):
+        matched_ids = photo_repo.index.query(
+            album=None if filter_album == "全部" else filter_album,
+            year=None if filter_year == "全部" else filter_year,
+            months=filter_months,
+            include_tags=filter_tags,
+            exclude_tags=exclude_tags,
+            untagged_only=show_untagged,
         )
+        filtered_photos = sort_photos(photo_repo.select(matched_ids), sort_option)
 
     st.write("")
     s_col1, s_col2, s_col3 = st.columns([2, 1, 1])
@@ -634,39 +740,87 @@ if page_mode == "📸 相簿瀏覽":
         else:
             st.warning("⚠️ 共找到 0 張照片。")
     with s_col2:
+        # 直接更新選取集合，不需要為每張照片建立元件
         if st.button("✅ 全選本頁", use_container_width=True):
-            for p in filtered_photos:
-                st.session_state[f"sel_{p['public_id']}"] = True
+            get_selected_ids().update(p["public_id"] for p in filtered_photos)
             st.rerun()
     with s_col3:
         if st.button("❎ 取消全選", use_container_width=True):
-            for p in filtered_photos:
-                st.session_state[f"sel_{p['public_id']}"] = False
+            get_selected_ids().difference_update(
+                p["public_id"] for p in filtered_photos
+            )
             st.rerun()
 
+    # --- 分頁：只為目前頁面的照片建立元件 ---
+    page_size_options = sorted({30, 60, 120, 240, GALLERY_PAGE_SIZE})
+    page_size = st.session_state.get("gallery_page_size", GALLERY_PAGE_SIZE)
+    total_pages = max(1, math.ceil(len(filtered_photos) / page_size))
+
+    # 篩選條件改變時回到第一頁
+    filter_signature = (
+        filter_album,
+        show_untagged,
+        tuple(filter_tags),
+        tuple(exclude_tags),
+        sort_option,
+        filter_year,
+        tuple(filter_months),
+        page_size,
+    )
+    if st.session_state.get("gallery_filter_signature") != filter_signature:
+        st.session_state["gallery_filter_signature"] = filter_signature
+        st.session_state["gallery_page"] = 1
+    st.session_state["gallery_page"] = min(
+        st.session_state.get("gallery_page", 1), total_pages
+    )
+
+    p_col1, p_col2, p_col3 = st.columns([1, 1, 2])
+    with p_col1:
+        st.selectbox(
+            "每頁張數",
+            page_size_options,
+            index=page_size_options.index(page_size),
+            key="gallery_page_size",
+        )
+    with p_col2:
+        current_page = st.number_input(
+            f"頁碼 (共 {total_pages} 頁)",
+            min_value=1,
+            max_value=total_pages,
+            step=1,
+            key="gallery_page",
+        )
+    with p_col3:
+        selected_count = len(get_selected_ids())
+        if selected_count:
+            st.write("")
+            st.caption(f"☑️ 已選取 {selected_count} 張 (切換頁面不會取消選取)")
+
+    page_start = (current_page - 1) * page_size
+    page_photos = filtered_photos[page_start : page_start + page_size]
+
     st.divider()
 
     # --- 照片展示區 ---
-    selected_photos = []
-    if filtered_photos:
-        with st.container():
+    selected_ids = get_selected_ids()
+    if page_photos:
+        with perf_timer("page.gallery_grid"), st.container():
             st.markdown(
                 '<div class="gallery-marker" style="display:none;"></div>',
                 unsafe_allow_html=True,
             )
 
-            for i in range(0, len(filtered_photos), 3):
+            for i in range(0, len(page_photos), 3):
                 cols = st.columns(3)
 
                 for j in range(3):
-                    if i + j < len(filtered_photos):
-                        photo = filtered_photos[i + j]
+                    if i + j < len(page_photos):
+                        photo = page_photos[i + j]
 
                         with cols[j]:
                             with st.container(border=True):
-                                st.image(
-                                    get_thumbnail_url(photo["url"]),
-                                    use_container_width=True,
+                                render_watermarked_image(
+                                    photo["url"], layout="grid", alt=photo["name"]
                                 )
 
                                 btn_col, check_col = st.columns([1, 4])
@@ -679,10 +833,14 @@ if page_mode == "📸 相簿瀏覽":
                                         show_large_image(photo)
                                 with check_col:
                                     key = f"sel_{photo['public_id']}"
-                                    if key not in st.session_state:
-                                        st.session_state[key] = False
-                                    is_selected = st.checkbox(
-                                        f"{photo['name']}", key=key
+                                    st.session_state[key] = (
+                                        photo["public_id"] in selected_ids
+                                    )
+                                    st.checkbox(
+                                        f"{photo['name']}",
+                                        key=key,
+                                        on_change=toggle_photo_selection,
+                                        args=(photo["public_id"],),
                                     )
 
                                 tags_str = (
@@ -705,17 +863,40 @@ if page_mode == "📸 相簿瀏覽":
                                         label_visibility="collapsed"
                                     )
                                     if st.button("💾 儲存標籤", key=f"save_card_tags_{photo['public_id']}", use_container_width=True):
-                                        for origin in st.session_state.gallery:
-                                            if origin["public_id"] == photo["public_id"]:
-                                                origin["tags"] = card_tags
-                                                break
-                                        save_db(st.session_state.gallery)
+                                        record_changes(
+                                            [
+                                                photo_repo.update(
+                                                    photo["public_id"], tags=card_tags
+                                                )
+                                            ]
+                                        )
                                         st.toast(f"✅ {photo['name']} 標籤已更新！")
                                         time.sleep(0.5)
                                         st.rerun()
 
-                                if is_selected:
-                                    selected_photos.append(photo)
+        if total_pages > 1:
+            n_col1, n_col2, n_col3 = st.columns([1, 2, 1])
+            n_col1.button(
+                "⬅️ 上一頁",
+                use_container_width=True,
+                disabled=current_page <= 1,
+                on_click=change_gallery_page,
+                args=(-1, total_pages),
+            )
+            n_col2.markdown(
+                f"<div style='text-align:center;'>第 {current_page} / {total_pages} 頁</div>",
+                unsafe_allow_html=True,
+            )
+            n_col3.button(
+                "下一頁 ➡️",
+                use_container_width=True,
+                disabled=current_page >= total_pages,
+                on_click=change_gallery_page,
+                args=(1, total_pages),
+            )
+
+    # 選取狀態可跨頁保留，批次操作以整個選取集合為準
+    selected_photos = photo_repo.select(selected_ids)
 
     # --- 批次操作控制面板 ---
     if selected_photos:
@@ -728,11 +909,45 @@ if page_mode == "📸 相簿瀏覽":
             # --- 分享連結（含浮水印開關） ---
             st.subheader("🔗 產生專屬分享連結")
             
-            enable_wm = st.checkbox("🔒 加上菱形 SAMPLE 防護浮水印（勾選後對方將看到輕透滿版保護線）", value=True)
+            enable_wm = st.checkbox(
+                "🔒 加上菱形 SAMPLE 浮水印（勾選後對方將看到輕透滿版格紋）",
+                value=True,
+                help="浮水印用來標示樣品，無法完全阻止他人取得原圖",
+            )
             
-            selected_pids = [p["public_id"] for p in selected_photos]
-            pids_query = ",".join(selected_pids)
-            wm_param = "&wm=1" if enable_wm else "&wm=0"
+            # 連結只帶短代碼，分享內容另存成雲端小檔；同樣的內容只需建立一次
+            share_token = make_share_token(
+                [p["public_id"] for p in selected_photos], enable_wm
+            )
+            created_shares = st.session_state.setdefault("created_shares", set())
+            if share_token not in created_shares:
+                # 預先請 Cloudinary 產生浮水印衍生圖，對方第一次開啟時不必等待即時轉換
+                pregenerate_wm = enable_wm and st.checkbox(
+                    "⚡ 建立連結時預先產生浮水印圖",
+                    value=True,
+                    disabled=WATERMARK_MODE == "css",
+                )
+                if st.button("🔗 產生分享連結", use_container_width=True):
+                    with st.spinner("建立分享連結中..."):
+                        if create_share(selected_photos, enable_wm):
+                            created_shares.add(share_token)
+                        else:
+                            st.error("❌ 建立分享連結失敗，請稍後再試。")
+                    if pregenerate_wm and share_token in created_shares:
+                        share_ids = [p["public_id"] for p in selected_photos]
+                        if WATERMARK_MODE == "local":
+                            submit_job(
+                                "預先合成浮水印圖",
+                                run_local_watermark_job,
+                                share_ids,
+                                THUMBNAIL_LAYOUTS["share"]["fallback_width"],
+                            )
+                        else:
+                            layer = resolve_watermark_layer()
+                            if layer:
+                                submit_job(
+                                    "預先產生浮水印圖", run_watermark_job, share_ids, layer
+                                )
 
             copy_code = f"""
             <div style="margin-bottom: 10px;">
@@ -753,7 +968,7 @@ if page_mode == "📸 相簿瀏覽":
                     parentPath = window.location.pathname;
                 }}
 
-                const fullShareUrl = parentOrigin + parentPath + "?share={pids_query}{wm_param}";
+                const fullShareUrl = parentOrigin + parentPath + "?s={share_token}";
                 
                 const inputEl = document.getElementById("shareUrlInput");
                 inputEl.value = fullShareUrl;
@@ -794,11 +1009,12 @@ if page_mode == "📸 相簿瀏覽":
             </script>
             """
 
-            components.html(copy_code, height=105)
+            if share_token in created_shares:
+                components.html(copy_code, height=105)
 
-            st.caption(
-                "💡 **說明**：點擊「一鍵複製完整分享連結」發給其他人，對方開啟後將只能看到選取的作品，且無法放大或下載圖片。"
-            )
+                st.caption(
+                    "💡 **說明**：點擊「一鍵複製完整分享連結」發給其他人，對方開啟後將只能看到選取的作品，且無法放大或下載圖片。"
+                )
 
             st.divider()
 
@@ -808,29 +1024,18 @@ if page_mode == "📸 相簿瀏覽":
                 action_tags = st.multiselect("設定標籤操作", ALL_TAG_OPTIONS)
 
                 btn_col1, btn_col2 = st.columns(2)
-                if btn_col1.button("➕ 加入標籤", use_container_width=True):
-                    for p in selected_photos:
-                        for origin in st.session_state.gallery:
-                            if origin["public_id"] == p["public_id"]:
-                                current_tags = origin.get("tags", [])
-                                origin["tags"] = list(
-                                    set(current_tags + action_tags)
-                                )
-                    save_db(st.session_state.gallery)
-                    request_clear_selections()
-                    st.toast("✅ 標籤已加入！")
-                    time.sleep(0.5)
-                    st.rerun()
-
-                if btn_col2.button("🔄 完全覆蓋", use_container_width=True):
-                    for p in selected_photos:
-                        for origin in st.session_state.gallery:
-                            if origin["public_id"] == p["public_id"]:
-                                origin["tags"] = action_tags
-                    save_db(st.session_state.gallery)
+                add_clicked = btn_col1.button("➕ 加入標籤", use_container_width=True)
+                overwrite_clicked = btn_col2.button("🔄 完全覆蓋", use_container_width=True)
+                if add_clicked or overwrite_clicked:
+                    verb = "覆蓋" if overwrite_clicked else "加入"
+                    submit_job(
+                        f"{verb} {len(selected_photos)} 張照片的標籤",
+                        run_tag_job,
+                        [p["public_id"] for p in selected_photos],
+                        list(action_tags),
+                        overwrite_clicked,
+                    )
                     request_clear_selections()
-                    st.toast("🔄 標籤已覆蓋！")
-                    time.sleep(0.5)
                     st.rerun()
 
             with act_c2:
@@ -839,20 +1044,13 @@ if page_mode == "📸 相簿瀏覽":
                 if st.button(
                     "🗑️ 刪除選取照片", type="primary", use_container_width=True
                 ):
-                    del_ids = {p["public_id"] for p in selected_photos}
-                    for pid in del_ids:
-                        delete_image_from_cloud(pid)
-
-                    st.session_state.gallery = [
-                        x
-                        for x in st.session_state.gallery
-                        if x["public_id"] not in del_ids
-                    ]
-
-                    save_db(st.session_state.gallery)
+                    # 只移除雲端確實刪除的照片，失敗的會在工作結束後重新選取以便重試
+                    submit_job(
+                        f"刪除 {len(selected_photos)} 張照片",
+                        run_delete_job,
+                        [p["public_id"] for p in selected_photos],
+                    )
                     request_clear_selections()
-                    st.success("已刪除！")
-                    time.sleep(0.5)
                     st.rerun()
 
             st.divider()
@@ -862,78 +1060,198 @@ if page_mode == "📸 相簿瀏覽":
                 on_click=request_clear_selections,
             )
 
-else:
+elif page_mode == "📊 數據統計":
     # -----------------------------------------------------------
     #  [統計頁面]
     # -----------------------------------------------------------
     st.header("📊 數據統計中心")
     st.write("查看不同相簿或整體的創作產量")
-
-    if not st.session_state.gallery:
-        st.info("無資料，請先上傳照片！")
-    else:
-        stat_album = st.selectbox(
-            "📂 選擇要統計的相簿", ["全部"] + existing_albums
-        )
-
-        if stat_album == "全部":
-            stat_photos = st.session_state.gallery
+    with perf_timer("page.stats"):
+        # 統計使用各相簿預先算好的摘要，不必下載所有照片紀錄
+        album_summaries = shared_gallery.album_summaries()
+        if not any(summary["count"] for summary in album_summaries.values()):
+            st.info("無資料，請先上傳照片！")
         else:
-            stat_photos = [
-                p for p in st.session_state.gallery if p["album"] == stat_album
-            ]
-
-        if not stat_photos:
-            st.warning(f"相簿 '{stat_album}' 裡面目前沒有照片喔！")
-        else:
-            total_photos = len(stat_photos)
-            untagged_count = len([p for p in stat_photos if not p["tags"]])
-            total_size_bytes = sum([p.get("size", 0) for p in stat_photos])
-
-            m1, m2, m3 = st.columns(3)
-            m1.metric("📸 照片數", total_photos)
-            m2.metric("❌ 未分類", untagged_count, delta_color="inverse")
-            m3.metric("💾 空間使用", format_file_size(total_size_bytes))
-
-            st.divider()
+            stat_album = st.selectbox(
+                "📂 選擇要統計的相簿", ["全部"] + existing_albums
+            )
 
-            raw_data = []
-            for p in stat_photos:
-                raw_data.append(
-                    {"Year": p["date"].year, "Month": p["date"].month}
+            if stat_album == "全部":
+                stat_summary = combine_summaries(album_summaries.values())
+            else:
+                stat_summary = combine_summaries(
+                    [album_summaries[stat_album]] if stat_album in album_summaries else []
                 )
 
-            if raw_data:
-                df = pd.DataFrame(raw_data)
-                pivot_df = pd.crosstab(df["Month"], df["Year"])
+            if not stat_summary["count"]:
+                st.warning(f"相簿 '{stat_album}' 裡面目前沒有照片喔！")
+            else:
+                total_photos = stat_summary["count"]
+                untagged_count = stat_summary["untagged"]
+                total_size_bytes = stat_summary["size"]
+
+                m1, m2, m3 = st.columns(3)
+                m1.metric("📸 照片數", total_photos)
+                m2.metric("❌ 未分類", untagged_count, delta_color="inverse")
+                m3.metric("💾 空間使用", format_file_size(total_size_bytes))
+
+                st.divider()
+
+                # 由彙總的年月張數直接組出「月份 x 年份」表，不必逐張照片交叉統計
+                pivot_df = month_year_table(stat_summary["months"])
+                available_years = list(pivot_df.columns)
+
+                if available_years:
+                    selected_years = st.multiselect(
+                        "📅 選擇要比較的年份 (可多選)：",
+                        options=available_years,
+                        default=available_years,
+                    )
 
-                all_months = list(range(1, 13))
-                pivot_df = pivot_df.reindex(all_months, fill_value=0)
+                    if selected_years:
+                        filtered_pivot = pivot_df[selected_years]
+
+                        st.subheader(f"📈 年度產量比較 ({stat_album})")
+                        st.bar_chart(filtered_pivot)
+
+                        st.divider()
+
+                        st.subheader(f"🗓️ 年度月別統計表 ({stat_album})")
+                        table_df = filtered_pivot.copy()
+                        table_df.loc["總計"] = table_df.sum()
+                        table_df.index.name = "月份"
+                        st.dataframe(table_df, use_container_width=True)
+
+                        # 各標籤的逐年張數同樣來自彙總
+                        tag_years = stat_summary["tag_years"]
+                        if tag_years:
+                            st.divider()
+                            st.subheader(f"🏷️ 標籤使用趨勢 ({stat_album})")
+                            tag_df = pd.DataFrame(
+                                [
+                                    [years.get(str(year), 0) for year in selected_years]
+                                    for years in tag_years.values()
+                                ],
+                                index=pd.Index(list(tag_years), name="標籤"),
+                                columns=selected_years,
+                            )
+                            tag_df["總計"] = tag_df.sum(axis=1)
+                            tag_df = tag_df[tag_df["總計"] > 0].sort_values(
+                                "總計", ascending=False
+                            )
+                            st.dataframe(tag_df, use_container_width=True)
+                    else:
+                        st.info(
+                            "💡 請至少選擇一個年份以顯示圖表與數據表。"
+                        )
 
-                available_years = sorted(list(pivot_df.columns), reverse=True)
-                selected_years = st.multiselect(
-                    "📅 選擇要比較的年份 (可多選)：",
-                    options=available_years,
-                    default=available_years,
-                )
+                if stat_album == "全部":
+                    st.divider()
+                    st.subheader("💾 各相簿空間使用")
+                    storage_df = pd.DataFrame(
+                        [
+                            (album, summary["count"], summary["size"] / (1024 * 1024))
+                            for album, summary in sorted(album_summaries.items())
+                            if summary["count"]
+                        ],
+                        columns=["相簿", "照片數", "容量 (MB)"],
+                    ).set_index("相簿")
+                    st.bar_chart(storage_df["容量 (MB)"])
+                    st.dataframe(
+                        storage_df.sort_values("容量 (MB)", ascending=False),
+                        use_container_width=True,
+                        column_config={
+                            "容量 (MB)": st.column_config.NumberColumn(format="%.1f")
+                        },
+                    )
 
-                if selected_years:
-                    filtered_pivot = pivot_df[selected_years]
+else:
+    # -----------------------------------------------------------
+    #  [效能監控頁面] (僅管理者網址可見)
+    # -----------------------------------------------------------
+    st.header("🩺 效能監控")
+    st.write("各項操作的耗時 (p50 / p95)、次數與傳輸量，用來找出變慢的環節")
 
-                    st.subheader(f"📈 年度產量比較 ({stat_album})")
-                    st.bar_chart(filtered_pivot)
+    perf_scope = st.radio(
+        "統計範圍",
+        ["本程序 (所有使用者與背景工作)", "本 session"],
+        horizontal=True,
+    )
+    perf_metrics = (
+        get_perf_metrics()
+        if perf_scope.startswith("本程序")
+        else st.session_state["perf_metrics"]
+    )
+    perf_snapshot = perf_metrics.snapshot()
+    st.caption(
+        "統計開始於 "
+        + datetime.datetime.fromtimestamp(perf_metrics.started_at).strftime("%Y-%m-%d %H:%M:%S")
+        + f"；百分位數與最大值取自每項最近 {PERF_SAMPLE_SIZE} 筆紀錄"
+    )
 
-                    st.divider()
+    if not perf_snapshot:
+        st.info("尚無紀錄，操作圖庫後再回來查看。")
+    else:
+        perf_df = pd.DataFrame(
+            [
+                (
+                    name,
+                    metric["count"],
+                    metric["errors"],
+                    metric["p50_ms"],
+                    metric["p95_ms"],
+                    metric["max_ms"],
+                    metric["mean_ms"],
+                    metric["total_ms"] / 1000,
+                    format_file_size(metric["bytes"]) if metric["bytes"] else "",
+                )
+                for name, metric in perf_snapshot.items()
+            ],
+            columns=[
+                "操作", "次數", "失敗", "p50 (ms)", "p95 (ms)", "最大 (ms)",
+                "平均 (ms)", "累計 (秒)", "傳輸量",
+            ],
+        ).set_index("操作")
+        st.dataframe(
+            perf_df.sort_values("累計 (秒)", ascending=False),
+            use_container_width=True,
+            column_config={
+                column: st.column_config.NumberColumn(format="%.1f")
+                for column in ["p50 (ms)", "p95 (ms)", "最大 (ms)", "平均 (ms)", "累計 (秒)"]
+            },
+        )
+        st.bar_chart(perf_df["p95 (ms)"])
 
-                    st.subheader(f"🗓️ 年度月別統計表 ({stat_album})")
-                    table_df = filtered_pivot.copy()
-                    table_df.loc["總計"] = table_df.sum()
-                    table_df.index.name = "月份"
-                    st.dataframe(table_df, use_container_width=True)
-                else:
-                    st.info(
-                        "💡 請至少選擇一個年份以顯示圖表與數據表。"
-                    )
+    prometheus_text = export_prometheus(perf_snapshot)
+    e_col1, e_col2, e_col3 = st.columns(3)
+    e_col1.download_button(
+        "⬇️ 匯出 JSON",
+        json.dumps(
+            {
+                "scope": "process" if perf_scope.startswith("本程序") else "session",
+                "started_at": perf_metrics.started_at,
+                "generated_at": time.time(),
+                "metrics": perf_snapshot,
+            },
+            ensure_ascii=False,
+            indent=2,
+        ),
+        file_name="gallery_metrics.json",
+        mime="application/json",
+        use_container_width=True,
+    )
+    e_col2.download_button(
+        "⬇️ 匯出 Prometheus 格式",
+        prometheus_text,
+        file_name="gallery_metrics.prom",
+        mime="text/plain",
+        use_container_width=True,
+    )
+    if e_col3.button("🧹 重設統計", use_container_width=True):
+        perf_metrics.reset()
+        st.rerun()
+    with st.expander("Prometheus 格式內容"):
+        st.code(prometheus_text, language="text")
 
 # 頁尾錨點 (供懸浮按鈕跳轉)
 st.markdown('<div id="bottom-anchor"></div>', unsafe_allow_html=True)
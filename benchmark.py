@@ -0,0 +1,486 @@
+"""
+雲端圖庫效能基準測試 (離線執行)
+
+以合成的圖庫 (相簿 / 標籤 / 日期分布接近實際使用) 與合成圖片，量測 gallery_core.py 的熱點：
+資料庫載入 / 寫入、篩選排序、統計表、圖片壓縮、縮圖網址與浮水印合成。
+Cloudinary 與 requests 以記憶體內的替身取代，不會連線到雲端。
+
+用法：
+    python benchmark.py                                  # 1k / 10k 張，結果 JSON 輸出到 stdout
+    python benchmark.py --sizes 1000 10000 100000 --output bench.json
+    python benchmark.py --compare bench.json             # 與先前的結果比較，變慢超過門檻時結束碼為 1
+"""
+
+import argparse
+from datetime import date
+import gc
+import gzip
+import hashlib
+from io import BytesIO
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+
+import cloudinary
+import cloudinary.api
+import cloudinary.uploader
+import numpy as np
+from PIL import Image, ImageFilter
+import requests
+
+import gallery_imaging
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# 結果中記錄這些檔案的雜湊，比較時才知道量測的是哪一版程式
+SOURCE_FILES = ("app.py", "gallery_core.py", "gallery_imaging.py")
+CLOUD_NAME = "benchmark"
+
+
+# --- 1. Cloudinary / requests 替身 ---
+class _Response:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}")
+
+
+class OfflineCloud:
+    """
+    Cloudinary 上傳 / Admin API 與 requests.get 的記憶體內替身。
+    raw 檔案 (資料庫快照、分片、增量紀錄) 照實保存，圖片網址回傳預先放入的 JPEG；
+    latency 可模擬每次網路往返的延遲 (秒)。
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.raw = {}
+        self.images = {}
+
+    def install(self, patch=setattr):
+        """
+        以替身取代模組屬性；patch 預設直接 setattr (基準測試不還原)，
+        測試傳入 monkeypatch.setattr，結束時自動還原。
+        """
+        config = cloudinary.config()
+        for key, value in dict(
+            cloud_name=CLOUD_NAME, api_key="offline", api_secret="offline", secure=True
+        ).items():
+            patch(config, key, value)
+        patch(cloudinary.uploader, "upload", self.upload)
+        patch(cloudinary.uploader, "explicit", self.explicit)
+        patch(cloudinary.api, "resources", self.resources)
+        patch(cloudinary.api, "delete_resources", self.delete_resources)
+        patch(requests, "get", self.get)
+
+    @staticmethod
+    def _public_id(url, marker):
+        path = url.split("?", 1)[0].split(marker, 1)[1]
+        first, _, rest = path.partition("/")
+        if first[:1] == "v" and first[1:].isdigit():
+            path = rest
+        return path
+
+    def get(self, url, timeout=None, headers=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        if "/raw/upload/" in url:
+            body = self.raw.get(self._public_id(url, "/raw/upload/"))
+            if body is None:
+                return _Response(404)
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if headers and headers.get("If-None-Match") == etag:
+                return _Response(304, headers={"ETag": etag})
+            return _Response(200, body, {"ETag": etag})
+        if "/image/upload/" in url:
+            public_id = url.split("?", 1)[0].rsplit("/", 1)[1].rsplit(".", 1)[0]
+            body = self.images.get(public_id)
+            return _Response(200, body) if body is not None else _Response(404)
+        return _Response(404)
+
+    def upload(self, file, public_id=None, resource_type="image", **options):
+        if self.latency:
+            time.sleep(self.latency)
+        data = file.read() if hasattr(file, "read") else bytes(file)
+        public_id = public_id or hashlib.sha1(data).hexdigest()[:20]
+        if resource_type == "raw":
+            self.raw[public_id] = data
+        else:
+            self.images[public_id] = data
+        return {
+            "public_id": public_id,
+            "version": 1,
+            "bytes": len(data),
+            "secure_url": f"https://res.cloudinary.com/{CLOUD_NAME}/{resource_type}/upload/v1/{public_id}",
+        }
+
+    def explicit(self, public_id, **options):
+        return {"public_id": public_id, "eager": [{} for _ in options.get("eager", [])]}
+
+    def resources(self, resource_type="image", prefix="", **options):
+        store = self.raw if resource_type == "raw" else self.images
+        return {
+            "resources": [
+                {"public_id": pid, "bytes": len(data)}
+                for pid, data in sorted(store.items())
+                if pid.startswith(prefix)
+            ]
+        }
+
+    def delete_resources(self, public_ids, resource_type="image", **options):
+        store = self.raw if resource_type == "raw" else self.images
+        return {
+            "deleted": {
+                pid: "deleted" if store.pop(pid, None) is not None else "not_found"
+                for pid in public_ids
+            }
+        }
+
+
+def load_core():
+    """安裝替身後匯入 gallery_core (設定、核心函數與類別)，不繪製頁面"""
+    # 在 streamlit run 之外執行會有 ScriptRunContext 等警告，與量測無關；
+    # 結果表輸出到 stderr，這些警告會混在其中，因此整個量測期間關閉 WARNING 以下的 log
+    logging.disable(logging.WARNING)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        import gallery_core
+    # 確保使用替身的連線設定 (不受 secrets 影響)
+    cloudinary.config(cloud_name=CLOUD_NAME, api_key="offline", api_secret="offline", secure=True)
+    return gallery_core
+
+
+# --- 2. 合成資料 ---
+CUSTOM_TAGS = [f"自訂{i:02d}" for i in range(30)]
+
+
+def synthetic_gallery(core, n, seed=0):
+    """
+    產生 n 張照片的合成圖庫：相簿大小呈長尾分布、標籤依常見組合出現 (約 12% 未分類)、
+    日期分布在近 6 年且逐年成長並帶季節起伏、檔案大小呈對數常態分布。
+    """
+    rng = random.Random(seed)
+    album_count = max(5, min(40, n // 2500))
+    albums = [f"相簿{i:02d}" for i in range(album_count - 1)] + ["未分類"]
+    album_weights = [1 / (i + 1) for i in range(album_count)]
+    years = list(range(date.today().year - 5, date.today().year + 1))
+    year_weights = [1 + i for i in range(len(years))]
+    month_weights = [6, 5, 6, 7, 7, 8, 10, 10, 8, 7, 8, 12]
+    prefix = core._image_url_prefix()
+
+    photos = []
+    for i in range(n):
+        day = date(
+            rng.choices(years, year_weights)[0],
+            rng.choices(range(1, 13), month_weights)[0],
+            rng.randint(1, 28),
+        )
+        tags = []
+        if rng.random() > 0.12:
+            tags.append("無償" if rng.random() < 0.6 else "非無償")
+            tags.append("單人" if rng.random() < 0.75 else "雙人")
+            tags.append("彩色" if rng.random() < 0.65 else "線稿")
+            for tag, p in (("人物", 0.5), ("風景", 0.15), ("生物", 0.1), ("✅SAMPLE", 0.05)):
+                if rng.random() < p:
+                    tags.append(tag)
+            if rng.random() < 0.3:
+                tags.append(rng.choice(CUSTOM_TAGS))
+        public_id = f"bench{seed}_{i:07d}"
+        photos.append(
+            {
+                "public_id": public_id,
+                "url": f"{prefix}v{1700000000 + i}/{public_id}.jpg",
+                "name": f"{day:%Y%m%d}_{i:06d}.jpg",
+                "date": day,
+                "tags": tags,
+                "album": rng.choices(albums, album_weights)[0],
+                "size": int(rng.lognormvariate(12.6, 0.6)),
+                "eager": list(core.EAGER_TRANSFORMATIONS) if rng.random() < 0.8 else [],
+                "sha256": f"{rng.getrandbits(256):064x}",
+                "phash": f"{rng.getrandbits(64):016x}" if rng.random() < 0.9 else None,
+            }
+        )
+    return photos
+
+
+def synthetic_image(width, height, fmt="JPEG", seed=0):
+    """平滑漸層 + 雜訊的合成圖片 (壓縮率接近一般插畫 / 照片)"""
+    rng = np.random.default_rng(seed)
+    small = (rng.random((max(2, height // 16), max(2, width // 16), 3)) * 255).astype("uint8")
+    img = Image.fromarray(small).resize((width, height), Image.Resampling.BICUBIC)
+    noise = rng.normal(0, 6, (height, width, 3))
+    img = Image.fromarray(np.clip(np.asarray(img, dtype=np.int16) + noise, 0, 255).astype("uint8"))
+    img = img.filter(ImageFilter.SMOOTH)
+    buffer = BytesIO()
+    img.save(buffer, format=fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+# --- 3. 量測 ---
+def measure(func, repeat, setup=None):
+    """執行 repeat 次 (每次先跑 setup，不計時)，回傳毫秒統計"""
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        gc.collect()
+        start = time.perf_counter()
+        func(arg) if setup else func()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "repeat": repeat,
+        "min_ms": round(min(times), 4),
+        "median_ms": round(statistics.median(times), 4),
+        "mean_ms": round(statistics.fmean(times), 4),
+        "max_ms": round(max(times), 4),
+    }
+
+
+def decode_all(core, payloads):
+    # 與 load_db 相同，解碼期間暫停 GC
+    with core.paused_gc():
+        return [core.decode_snapshot(json.loads(gzip.decompress(p))) for p in payloads]
+
+
+def bench_database(core, cloud, photos, repeat):
+    """
+    save_db (依相簿分片編碼 + 上傳) 與 load_db (manifest + 分片下載解碼 + 增量紀錄)；
+    load_db_cached 代表分片已在快取中、只需解碼的情況。
+    """
+    cloud.raw.clear()
+    results = [("save_db", {}, measure(lambda: core.save_db(photos, 1, "bench"), repeat))]
+    results.append(("load_db", {}, measure(lambda: core.load_db(), repeat)))
+    shard_cache = {}
+    core.load_db(shard_cache)
+    results.append(("load_db_cached", {}, measure(lambda: core.load_db(shard_cache), repeat)))
+    payloads = [data for pid, data in cloud.raw.items() if pid.startswith(core.DB_SHARD_PREFIX)]
+    results.append(
+        (
+            "decode_shards",
+            {"shards": len(payloads), "bytes": sum(map(len, payloads))},
+            measure(lambda: decode_all(core, payloads), repeat),
+        )
+    )
+    results.append(("repository_build", {}, measure(lambda: core.PhotoRepository(photos), repeat)))
+    return results
+
+
+FILTER_CASES = {
+    "all_date_desc": ({}, "日期 (新→舊)"),
+    "album_tag": ({"album": "相簿00", "include_tags": ["彩色"]}, "日期 (新→舊)"),
+    "exclude_tags_name": ({"exclude_tags": ["非無償", "線稿"]}, "檔名 (A→Z)"),
+    "year_months": ({"year": date.today().year - 1, "months": [6, 7, 8]}, "日期 (舊→新)"),
+    "untagged": ({"untagged_only": True}, "標籤 (A→Z)"),
+}
+
+
+def bench_filter(core, photos, repeat):
+    """相簿瀏覽的篩選 (倒排索引查詢) + 取出照片 + 排序"""
+    repo = core.PhotoRepository(photos)
+    results = []
+    for case, (query, sort_option) in FILTER_CASES.items():
+
+        def run(query=query, sort_option=sort_option):
+            core.sort_photos(repo.select(repo.index.query(**query)), sort_option)
+
+        matched = len(repo.index.query(**query))
+        results.append(("filter_sort", {"case": case, "matched": matched}, measure(run, repeat)))
+
+    probes = [p["public_id"] for p in photos[:: max(1, len(photos) // 20)] if p["phash"]]
+    results.append(
+        (
+            "find_similar",
+            {"probes": len(probes)},
+            measure(lambda: [repo.find_similar(pid) for pid in probes], repeat),
+        )
+    )
+    return results
+
+
+def bench_stats(core, photos, repeat):
+    """統計頁面：合併各相簿彙總並組出月份 x 年份表，以及寫入 manifest 時的整批摘要"""
+    repo = core.PhotoRepository(photos)
+    albums = sorted(repo.index.stats)
+
+    def stats_page():
+        summary = core.combine_summaries([repo.album_stats(a) for a in albums])
+        core.month_year_table(summary["months"])
+
+    return [
+        ("stats_page", {}, measure(stats_page, repeat)),
+        ("album_summary_rescan", {}, measure(lambda: core.album_summary(photos), repeat)),
+    ]
+
+
+def bench_urls(core, photos, repeat):
+    """縮圖網址 (每次呼叫的平均微秒數) 與格狀縮圖 <img> 產生"""
+    urls = [p["url"] for p in photos[:10000]]
+
+    def thumbnail_urls():
+        for url in urls:
+            core.get_thumbnail_url(url, width=400)
+
+    def thumbnail_imgs():
+        for url in urls:
+            core.build_thumbnail_img(url, layout="grid")
+
+    results = []
+    for name, func in (("get_thumbnail_url", thumbnail_urls), ("build_thumbnail_img", thumbnail_imgs)):
+        timing = measure(func, repeat)
+        timing["per_call_us"] = round(timing["median_ms"] * 1000 / len(urls), 3)
+        results.append((name, {"calls": len(urls)}, timing))
+    return results
+
+
+IMAGE_SIZES = [(1024, 768), (2048, 1536), (4032, 3024), (6000, 4000)]
+
+
+def bench_images(core, repeat):
+    """compress_image 於不同解析度 (JPEG 與 PNG)，以及本機浮水印合成"""
+    results = []
+    for width, height in IMAGE_SIZES:
+        for fmt in ("JPEG", "PNG") if width == 2048 else ("JPEG",):
+            data = synthetic_image(width, height, fmt)
+            timing = measure(lambda data=data: gallery_imaging.compress_image(BytesIO(data)), repeat)
+            results.append(
+                ("compress_image", {"resolution": f"{width}x{height}", "format": fmt, "bytes": len(data)}, timing)
+            )
+    data = synthetic_image(2048, 1536)
+    core.render_local_watermark(data, 800)  # 預先建立圖塊與平鋪圖層
+    results.append(
+        (
+            "render_local_watermark",
+            {"resolution": "2048x1536", "width": 800},
+            measure(lambda: core.render_local_watermark(data, 800), repeat),
+        )
+    )
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(sizes, repeat, latency, seed):
+    cloud = OfflineCloud(latency=latency)
+    cloud.install()
+    core = load_core()
+    digest = hashlib.sha256()
+    for name in SOURCE_FILES:
+        with open(os.path.join(ROOT, name), "rb") as f:
+            digest.update(f.read())
+
+    results = []
+
+    def add(entries, **params):
+        for name, extra, timing in entries:
+            results.append({"name": name, "params": {**params, **extra}, **timing})
+            print(f"{name:24s} {json.dumps({**params, **extra}, ensure_ascii=False):60s} "
+                  f"{timing['median_ms']:10.3f} ms", file=sys.stderr)
+
+    for n in sizes:
+        photos = synthetic_gallery(core, n, seed)
+        # 大圖庫的單次量測已足夠穩定，減少重複次數
+        size_repeat = max(1, repeat if n < 100000 else repeat // 2)
+        add(bench_database(core, cloud, photos, size_repeat), photos=n)
+        add(bench_filter(core, photos, repeat), photos=n)
+        add(bench_stats(core, photos, repeat), photos=n)
+    add(bench_urls(core, synthetic_gallery(core, 10000, seed), repeat))
+    add(bench_images(core, repeat))
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "source_sha256": digest.hexdigest()[:16],
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "sizes": sizes,
+            "repeat": repeat,
+            "latency_ms": latency * 1000,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def result_key(entry):
+    return (entry["name"], json.dumps(entry["params"], sort_keys=True, ensure_ascii=False))
+
+
+def compare(baseline, current, threshold):
+    """比較兩次結果的中位數，回傳變慢超過 threshold (比例) 的項目清單"""
+    old = {result_key(e): e for e in baseline["results"]}
+    regressions = []
+    for entry in current["results"]:
+        before = old.get(result_key(entry))
+        if not before or not before["median_ms"]:
+            continue
+        change = entry["median_ms"] / before["median_ms"] - 1
+        marker = "  <-- 變慢" if change > threshold else ""
+        print(
+            f"{entry['name']:24s} {result_key(entry)[1]:60s} "
+            f"{before['median_ms']:10.3f} -> {entry['median_ms']:10.3f} ms ({change:+.1%}){marker}",
+            file=sys.stderr,
+        )
+        if change > threshold:
+            regressions.append(entry)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="雲端圖庫效能基準測試 (離線)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="合成圖庫的照片數")
+    parser.add_argument("--repeat", type=int, default=5, help="每項量測的重複次數")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="模擬每次雲端請求的延遲 (毫秒)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果 JSON 的輸出檔 (預設輸出到 stdout)")
+    parser.add_argument("--compare", help="先前的結果 JSON，比較中位數並標出變慢的項目")
+    parser.add_argument("--threshold", type=float, default=0.2, help="視為變慢的比例 (預設 0.2 = 20%%)")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.repeat, args.latency_ms / 1000, args.seed)
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} 項變慢超過 {args.threshold:.0%}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2608 @@
+"""
+雲端圖庫的核心功能：設定、雲端存取、資料庫快照 / 增量紀錄、索引與統計、
+縮圖網址與浮水印、背景工作與效能量測。
+
+app.py 只負責頁面與互動；benchmark.py 與測試直接匯入本模組，不必執行頁面。
+"""
+
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import (
+    BrokenExecutor,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+)
+import datetime
+import functools
+import gc
+import gzip
+import hashlib
+import html
+from io import BytesIO
+import json
+import os
+import random
+import threading
+import time
+import uuid
+import cloudinary
+import cloudinary.api
+import cloudinary.uploader
+import numpy as np
+import pandas as pd
+from PIL import ExifTags, Image, ImageDraw, ImageFont, ImageOps
+import requests
+import streamlit as st
+
+from gallery_imaging import (
+    compress_image_bytes,
+    discard_compress_pool,
+    get_compress_pool,
+)
+
+# 快照：依相簿分片 (v4)，manifest 記錄各分片檔案與統計摘要，
+# 分片內容為 gzip 壓縮的欄式格式並以內容雜湊命名 (內容不變則檔名不變)
+DB_MANIFEST_FILENAME = "photo_db_v4_manifest.json"
+DB_SHARD_PREFIX = "photo_db_v4_shards/"
+# 舊版單一快照 (v3 欄式 / v2 JSON)，只在自動遷移時讀取
+DB_SNAPSHOT_FILENAME = "photo_db_v3.json.gz"
+DB_FILENAME = "photo_db_v2.json"
+# 增量紀錄 (journal)：每次異動寫一筆小檔，累積到門檻再壓實成新快照
+DB_JOURNAL_PREFIX = "photo_db_v2_journal/"
+JOURNAL_COMPACT_THRESHOLD = 50
+# 快照寫入發生衝突 (其他程序同時寫入) 時的重試次數
+SNAPSHOT_WRITE_RETRIES = 5
+# 被新快照取代的分片與已壓實的增量紀錄至少保留這麼久 (秒) 才刪除：同時進行的壓實
+# 或讀到舊 manifest 的程序可能還在引用它們，由之後的壓實延後清除
+DB_GC_DELAY = 600
+# 分享連結：每個分享代碼對應一個記錄照片 ID 與浮水印設定的小檔
+DB_SHARE_PREFIX = "photo_db_shares/"
+SHARE_CACHE_SIZE = 512
+# 版本標記：任何寫入都會更新此小檔，其他伺服器程序據此判斷是否需重新載入
+DB_HEAD_FILENAME = "photo_db_v2_head.json"
+
+# --- 批次上傳並行設定 (可於 secrets.toml 的 [gallery] 區段覆寫) ---
+_gallery_settings = st.secrets["gallery"] if "gallery" in st.secrets else {}
+UPLOAD_CONCURRENCY = max(1, int(_gallery_settings.get("upload_concurrency", 4)))
+COMPRESS_WORKERS = max(
+    1, int(_gallery_settings.get("compress_workers", min(4, os.cpu_count() or 1)))
+)
+# 相簿瀏覽每頁顯示的照片數 (只為本頁建立元件)
+GALLERY_PAGE_SIZE = max(3, int(_gallery_settings.get("page_size", 60)))
+# 共用快取向雲端確認版本的最短間隔 (秒)
+DB_REFRESH_INTERVAL = float(_gallery_settings.get("db_refresh_interval", 30))
+# 批次刪除：Admin API 每次最多 100 個 ID，同時進行的批次數
+DELETE_BATCH_SIZE = 100
+DELETE_CONCURRENCY = max(1, int(_gallery_settings.get("delete_concurrency", 3)))
+# 背景工作：工作執行緒數、保留的已完成紀錄數、進度更新間隔 (秒)
+JOB_WORKERS = max(1, int(_gallery_settings.get("job_workers", 2)))
+JOB_HISTORY_LIMIT = 20
+JOB_POLL_INTERVAL = 1.0
+# 工作紀錄同時寫入本機檔案，伺服器重新啟動後仍可查詢 (未完成的工作標記為中斷)
+JOB_RECORD_PATH = _gallery_settings.get(
+    "job_record_path",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".job_records.json"),
+)
+# 延遲合併寫入：異動累積在記憶體，最多每 FLUSH_INTERVAL 秒上傳一次；
+# 尚未上傳的異動同時寫入本機暫存檔，程序中斷後重新啟動時會補傳
+FLUSH_INTERVAL = float(_gallery_settings.get("flush_interval", 5))
+# 分享頁浮水印："overlay" 由 Cloudinary 把浮水印疊在衍生圖上 (網址帶簽章，需在 Cloudinary
+# 開啟 Strict transformations 才能阻止改寫轉換參數，見 signed_delivery_url)，
+# "local" 在本機以 Pillow 合成 (不依賴 Cloudinary 轉換)，"css" 為舊做法，只在縮圖上方蓋一層 CSS 網格
+WATERMARK_MODE = _gallery_settings.get("watermark_mode", "overlay")
+# 本機合成浮水印：平行合成的執行緒數，磁碟快取的位置與容量上限 (MB)，
+# 以及寫到一半的暫存檔保留多久 (秒) 後視為程序中斷留下的殘檔
+WATERMARK_WORKERS = max(
+    1, int(_gallery_settings.get("watermark_workers", min(4, os.cpu_count() or 1)))
+)
+WATERMARK_CACHE_DIR = _gallery_settings.get(
+    "watermark_cache_dir",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".watermark_cache"),
+)
+WATERMARK_CACHE_MAX_BYTES = int(_gallery_settings.get("watermark_cache_mb", 256)) * 1024 * 1024
+WATERMARK_TMP_MAX_AGE = 600
+PENDING_SPOOL_PATH = _gallery_settings.get(
+    "pending_spool_path",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".pending_changes.jsonl"),
+)
+# 效能監控頁：網址帶 ?admin=<admin_token> 才會在側邊欄出現 (未設定則不開放)
+ADMIN_TOKEN = _gallery_settings.get("admin_token")
+
+# --- 效能量測：耗時、次數與傳輸量，程序層級與每個 session 各一份 ---
+# 每項指標保留最近的耗時樣本數 (用來計算 p50 / p95)
+PERF_SAMPLE_SIZE = 1024
+
+
+class PerfMetrics:
+    """各項操作的次數、失敗數、累計耗時、傳輸量與最近耗時樣本 (可跨執行緒記錄)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.started_at = time.time()
+
+    def record(self, name, seconds, nbytes=0, error=False):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = {
+                    "count": 0,
+                    "errors": 0,
+                    "seconds": 0.0,
+                    "bytes": 0,
+                    "samples": deque(maxlen=PERF_SAMPLE_SIZE),
+                }
+            metric["count"] += 1
+            metric["errors"] += int(error)
+            metric["seconds"] += seconds
+            metric["bytes"] += nbytes
+            metric["samples"].append(seconds)
+
+    def snapshot(self):
+        """回傳 {指標名稱: 統計}，耗時單位為毫秒 (百分位數與最大值取自最近的樣本)"""
+        with self.lock:
+            metrics = {
+                name: dict(metric, samples=list(metric["samples"]))
+                for name, metric in self.metrics.items()
+            }
+        result = {}
+        for name in sorted(metrics):
+            metric = metrics[name]
+            p50, p95, slowest = np.percentile(metric["samples"], [50, 95, 100]) * 1000
+            result[name] = {
+                "count": metric["count"],
+                "errors": metric["errors"],
+                "total_ms": round(metric["seconds"] * 1000, 3),
+                "mean_ms": round(metric["seconds"] * 1000 / metric["count"], 3),
+                "p50_ms": round(float(p50), 3),
+                "p95_ms": round(float(p95), 3),
+                "max_ms": round(float(slowest), 3),
+                "bytes": metric["bytes"],
+            }
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.metrics.clear()
+            self.started_at = time.time()
+
+
+@st.cache_resource
+def get_perf_metrics():
+    """程序層級的效能統計 (所有 session 與背景工作共用)"""
+    return PerfMetrics()
+
+
+# 目前執行緒所屬 session 的統計；背景工作執行緒沒有 session，只記入程序層級
+_perf_local = threading.local()
+
+
+def bind_session_metrics():
+    """每次執行腳本時把本 session 的統計綁定到目前的執行緒"""
+    _perf_local.session = st.session_state.setdefault("perf_metrics", PerfMetrics())
+
+
+def record_timing(name, seconds, nbytes=0, error=False):
+    get_perf_metrics().record(name, seconds, nbytes, error)
+    session = getattr(_perf_local, "session", None)
+    if session is not None:
+        session.record(name, seconds, nbytes, error)
+
+
+@contextmanager
+def perf_timer(name):
+    """
+    量測 with 區塊的耗時；區塊內可設定 sample["bytes"] 記錄傳輸量。
+    區塊拋出 Exception 時記為失敗後照常拋出；st.rerun / st.stop 的控制例外
+    (BaseException) 不算失敗，耗時仍照常記錄。
+    """
+    sample = {"bytes": 0}
+    started = time.perf_counter()
+    error = False
+    try:
+        yield sample
+    except Exception:
+        error = True
+        raise
+    finally:
+        record_timing(name, time.perf_counter() - started, sample["bytes"], error=error)
+
+
+def instrumented(name):
+    """裝飾器：以 perf_timer 量測整個函式呼叫"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with perf_timer(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _payload_size(file):
+    if isinstance(file, (bytes, bytearray)):
+        return len(file)
+    if isinstance(file, BytesIO):
+        return file.getbuffer().nbytes
+    return 0
+
+
+def cloud_upload(file, **options):
+    """cloudinary.uploader.upload 並記錄耗時與上傳量 (指標依 resource_type 區分)"""
+    name = f"cloudinary.upload.{options.get('resource_type', 'image')}"
+    with perf_timer(name) as sample:
+        sample["bytes"] = _payload_size(file)
+        return cloudinary.uploader.upload(file, **options)
+
+
+def cloud_fetch(url, **kwargs):
+    """requests.get 下載 Cloudinary 上的檔案並記錄耗時與下載量 (指標依 raw / 圖片區分)"""
+    name = "cloudinary.fetch.raw" if "/raw/upload/" in url else "cloudinary.fetch.image"
+    with perf_timer(name) as sample:
+        response = requests.get(url, **kwargs)
+        sample["bytes"] = len(response.content)
+        return response
+
+
+def cloud_delete(public_ids, **options):
+    """cloudinary.api.delete_resources 並記錄耗時"""
+    with perf_timer(f"cloudinary.delete.{options.get('resource_type', 'image')}"):
+        return cloudinary.api.delete_resources(public_ids, **options)
+
+
+def export_prometheus(metrics, prefix="gallery"):
+    """將 PerfMetrics.snapshot() 轉成 Prometheus 文字格式 (同一指標的各行集中輸出)"""
+    family = f"{prefix}_operation_seconds"
+    lines = [
+        f"# HELP {family} 各項操作的耗時 (百分位數取自最近的樣本)",
+        f"# TYPE {family} summary",
+    ]
+    for name, metric in metrics.items():
+        for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms")):
+            lines.append(
+                f'{family}{{operation="{name}",quantile="{quantile}"}} {metric[key] / 1000:.6f}'
+            )
+        lines.append(f'{family}_sum{{operation="{name}"}} {metric["total_ms"] / 1000:.6f}')
+        lines.append(f'{family}_count{{operation="{name}"}} {metric["count"]}')
+    for suffix, key, description in (
+        ("errors_total", "errors", "各項操作的失敗次數"),
+        ("bytes_total", "bytes", "各項操作的傳輸位元組數"),
+    ):
+        family = f"{prefix}_operation_{suffix}"
+        lines += [f"# HELP {family} {description}", f"# TYPE {family} counter"]
+        lines += [
+            f'{family}{{operation="{name}"}} {metric[key]}'
+            for name, metric in metrics.items()
+        ]
+    return "\n".join(lines) + "\n"
+
+
+# --- 縮圖尺寸組合 ---
+# srcset 提供多種寬度，由瀏覽器依版面寬度與螢幕密度 (DPR) 自行挑選
+THUMBNAIL_WIDTHS = (200, 400, 800, 1600)
+# 各版面的顯示寬度：後台格狀在手機為 2 欄，分享頁在手機為單欄，桌機皆為 3 欄
+THUMBNAIL_LAYOUTS = {
+    "grid": {"sizes": "(max-width: 640px) 50vw, 33vw", "fallback_width": 400},
+    "share": {"sizes": "(max-width: 640px) 100vw, 33vw", "fallback_width": 800},
+}
+# 照片詳情視窗使用的大圖寬度
+MODAL_WIDTH = 1600
+PLACEHOLDER_TRANSFORMATION = "w_32,e_blur:200,q_auto:low,f_auto"
+
+
+def thumbnail_transformation(width, dpr=None):
+    transformation = f"w_{width},c_scale,q_auto,f_auto"
+    if dpr:
+        transformation += f",dpr_{dpr}"
+    return transformation
+
+
+# 上傳時請 Cloudinary 預先產生的衍生圖 (格狀 / 分享頁常用寬度、詳情大圖與模糊預覽圖)，
+# 第一位訪客就不必等待即時轉換；字串須與實際網址中的轉換參數完全一致才會命中
+EAGER_TRANSFORMATIONS = [
+    thumbnail_transformation(400),
+    thumbnail_transformation(800),
+    thumbnail_transformation(MODAL_WIDTH),
+    PLACEHOLDER_TRANSFORMATION,
+]
+
+
+# 浮水印衍生圖：分享頁 srcset 使用的寬度，以及平鋪用圖塊的大小與存放位置
+WATERMARK_WIDTHS = (400, 800, 1600)
+WATERMARK_TILE_SIZE = 140
+WATERMARK_ASSET_PREFIX = "gallery_assets/watermark_"
+
+
+def watermark_transformation(width, layer):
+    """縮放後平鋪浮水印圖塊，浮水印烘焙在衍生圖中並由 CDN 快取"""
+    return f"w_{width},c_scale/l_{layer}/fl_layer_apply,fl_tiled/q_auto,f_auto"
+
+
+@functools.lru_cache(maxsize=16384)
+def signed_delivery_url(url, transformation):
+    """
+    原圖網址 (url) 加上轉換參數後的衍生圖網址，帶 Cloudinary 簽章 (sign_url)。
+    所有衍生圖網址都經過這裡，因此帳號可開啟 Strict transformations
+    (Settings → Security)：未簽章、也不是預先產生的轉換網址會被拒絕，
+    改動或拿掉轉換參數 (例如浮水印圖層) 後簽章即失效；原圖網址 (不含轉換) 不受影響。
+    簽章要算 SHA-1 並組網址 (約 0.1ms)，以網址快取。
+    """
+    path = url.split("?", 1)[0].split("/upload/", 1)[1]
+    version, _, rest = path.partition("/")
+    if not (version[:1] == "v" and version[1:].isdigit()):
+        version, rest = None, path
+    public_id, dot, fmt = rest.rpartition(".")
+    if not dot:
+        public_id, fmt = rest, None
+    signed_url, options = cloudinary.utils.cloudinary_url(
+        public_id,
+        format=fmt,
+        version=version[1:] if version else None,
+        raw_transformation=transformation,
+        sign_url=True,
+    )
+    return signed_url
+
+
+def get_thumbnail_url(url, width=800, dpr=None):
+    """利用 Cloudinary 動態轉換取得輕量縮圖 (dpr="auto" 時由 Cloudinary 依裝置密度放大)"""
+    if "/upload/" in url:
+        return signed_delivery_url(url, thumbnail_transformation(width, dpr))
+    return url
+
+
+def get_placeholder_url(url):
+    """極小的模糊預覽圖 (約 1KB)，在正式縮圖載入前當作背景"""
+    if "/upload/" in url:
+        return signed_delivery_url(url, PLACEHOLDER_TRANSFORMATION)
+    return url
+
+
+def get_watermarked_url(url, width, layer):
+    """疊上浮水印圖塊 (layer) 的縮圖網址 (帶簽章，拿掉浮水印圖層後網址即失效)"""
+    if "/upload/" in url:
+        return signed_delivery_url(url, watermark_transformation(width, layer))
+    return url
+
+
+def build_srcset(url, widths=THUMBNAIL_WIDTHS, watermark_layer=None):
+    if watermark_layer:
+        return ", ".join(
+            f"{get_watermarked_url(url, w, watermark_layer)} {w}w" for w in widths
+        )
+    return ", ".join(f"{get_thumbnail_url(url, width=w)} {w}w" for w in widths)
+
+
+def build_thumbnail_img(url, layout="grid", alt="", watermark_layer=None):
+    """
+    產生帶 srcset / sizes 的 <img>；不支援 srcset 的瀏覽器改用 dpr_auto 的單一縮圖。
+    圖片延遲到捲動接近時才載入 (loading="lazy")，載入前顯示模糊預覽圖。
+    指定 watermark_layer 時所有尺寸都改用疊好浮水印的衍生圖。
+    """
+    spec = THUMBNAIL_LAYOUTS[layout]
+    srcset_attrs = ""
+    if watermark_layer and "/upload/" in url:
+        src = get_watermarked_url(url, spec["fallback_width"], watermark_layer)
+        srcset = build_srcset(url, WATERMARK_WIDTHS, watermark_layer)
+        srcset_attrs = f' srcset="{srcset}" sizes="{spec["sizes"]}"'
+    else:
+        src = get_thumbnail_url(url, width=spec["fallback_width"], dpr="auto")
+        if "/upload/" in url:
+            srcset_attrs = f' srcset="{build_srcset(url)}" sizes="{spec["sizes"]}"'
+    return (
+        f'<img class="lazy-thumb" src="{src}"{srcset_attrs} '
+        f'loading="lazy" decoding="async" alt="{html.escape(alt)}" '
+        f"style=\"background-image:url('{get_placeholder_url(url)}');\">"
+    )
+
+
+def make_watermark_tile(size=WATERMARK_TILE_SIZE):
+    """產生可平鋪的菱形網格 + SAMPLE 字樣浮水印圖塊 (半透明 PNG)"""
+    tile = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(tile)
+    half = size // 2
+    # 圖塊中央的菱形，平鋪後與相鄰圖塊連成滿版網格
+    draw.line(
+        [(half, 0), (size, half), (half, size), (0, half), (half, 0)],
+        fill=(0, 0, 0, 60),
+        width=1,
+    )
+    try:
+        font = ImageFont.load_default(size=size // 8)
+    except TypeError:  # Pillow < 10.1 只有固定大小的點陣字型
+        font = ImageFont.load_default()
+    left, top, right, bottom = draw.textbbox((0, 0), "SAMPLE", font=font)
+    draw.text(
+        ((size - right - left) / 2, (size - bottom - top) / 2),
+        "SAMPLE",
+        font=font,
+        fill=(255, 255, 255, 110),
+        stroke_width=1,
+        stroke_fill=(0, 0, 0, 70),
+    )
+    buffer = BytesIO()
+    tile.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+@st.cache_resource(show_spinner=False)
+def get_watermark_layer():
+    """
+    確保浮水印圖塊已上傳 (以內容雜湊命名，圖樣不變就不會重複上傳)，
+    回傳轉換參數中使用的 overlay ID；失敗時拋出例外 (不會被快取)。
+    """
+    tile = make_watermark_tile()
+    public_id = f"{WATERMARK_ASSET_PREFIX}{hashlib.sha256(tile).hexdigest()[:12]}"
+    url, options = cloudinary.utils.cloudinary_url(public_id, format="png")
+    if cloud_fetch(url, timeout=10).status_code != 200:
+        cloud_upload(
+            BytesIO(tile), public_id=public_id, overwrite=False
+        )
+    return public_id.replace("/", ":")
+
+
+def resolve_watermark_layer():
+    """取得浮水印圖塊的 overlay ID；設定為 CSS 模式或圖塊無法使用時回傳 None"""
+    if WATERMARK_MODE != "overlay":
+        return None
+    try:
+        return get_watermark_layer()
+    except Exception as e:
+        print(f"浮水印圖塊無法使用，改用 CSS 浮水印: {e}")
+        return None
+
+
+def format_file_size(size_in_bytes):
+    if not size_in_bytes:
+        return "未知"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size_in_bytes < 1024:
+            return f"{size_in_bytes:.1f} {unit}"
+        size_in_bytes /= 1024
+    return f"{size_in_bytes:.1f} GB"
+
+
+@st.cache_resource(show_spinner=False)
+def watermark_tile_image():
+    """浮水印圖塊 (與 Cloudinary 疊圖使用同一個圖樣)，每個程序只繪製一次"""
+    return Image.open(BytesIO(make_watermark_tile())).convert("RGBA")
+
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def watermark_overlay(width, height):
+    """
+    把圖塊以 numpy 一次平鋪成 width x height 的浮水印圖層。
+    高度以 4 個圖塊為單位進位後快取，常見尺寸只建一次、記憶體用量有上限。
+    """
+    tile = np.asarray(watermark_tile_image())
+    tile_h, tile_w = tile.shape[:2]
+    reps = (-(-height // tile_h), -(-width // tile_w), 1)
+    return Image.fromarray(np.tile(tile, reps)[:height, :width])
+
+
+def render_local_watermark(data, width):
+    """
+    在本機把圖片縮成寬度最多 width 的 JPEG 並疊上平鋪浮水印。
+    JPEG 以 draft() 在解碼階段縮小，整張圖只做一次 alpha 合成。
+    """
+    img = Image.open(BytesIO(data))
+    try:
+        orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+    except Exception:
+        orientation = 1
+    src_w, src_h = img.size
+    # draft 只會縮到不小於要求的尺寸；方向 5~8 轉正後的寬度是原始高度
+    if orientation in (5, 6, 7, 8):
+        img.draft("RGB", (max(1, src_w * width // src_h), width))
+    else:
+        img.draft("RGB", (width, max(1, src_h * width // src_w)))
+    img = ImageOps.exif_transpose(img)
+    if img.width > width:
+        height = max(1, round(img.height * width / img.width))
+        img = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    bucket = WATERMARK_TILE_SIZE * 4
+    overlay = watermark_overlay(img.width, -(-img.height // bucket) * bucket)
+    img = Image.alpha_composite(
+        img.convert("RGBA"), overlay.crop((0, 0, img.width, img.height))
+    )
+    output_buffer = BytesIO()
+    img.convert("RGB").save(output_buffer, format="JPEG", quality=80)
+    return output_buffer.getvalue()
+
+
+class WatermarkCache:
+    """
+    本機合成浮水印圖的磁碟 LRU 快取，以 (public_id, 網址, 寬度) 為鍵。
+    總容量超過 max_bytes 時刪除最久未使用的檔案；使用順序記在記憶體，
+    重新啟動時依檔案修改時間還原 (讀取時會更新修改時間)；
+    程序中斷時寫到一半留下的暫存檔 (超過 WATERMARK_TMP_MAX_AGE 秒) 在開啟快取時清除。
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # 檔名 -> 大小，依使用時間由舊到新
+        self.total = 0
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                try:
+                    # 其他程序可能正在寫入，只清除夠舊的暫存檔
+                    if time.time() - entry.stat().st_mtime > WATERMARK_TMP_MAX_AGE:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+            elif entry.name.endswith(".jpg"):
+                info = entry.stat()
+                files.append((info.st_mtime, entry.name, info.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total += size
+        with self.lock:
+            self._evict()
+
+    @staticmethod
+    def filename(public_id, url, width):
+        # 網址含版本號，圖片被覆蓋更新後自然換成新的快取檔
+        digest = hashlib.sha256(f"{public_id}\n{url}".encode("utf-8")).hexdigest()[:32]
+        return f"{digest}_{width}.jpg"
+
+    def get(self, public_id, url, width):
+        name = self.filename(public_id, url, width)
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.total -= self.entries.pop(name, 0)
+            return None
+        return data
+
+    def put(self, public_id, url, width, data):
+        name = self.filename(public_id, url, width)
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"寫入浮水印快取失敗: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            self.total += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            self._evict()
+
+    def _evict(self):
+        """刪除最久未使用的檔案直到總容量不超過上限 (需持有 lock)"""
+        while self.total > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+@st.cache_resource
+def get_watermark_cache():
+    return WatermarkCache(WATERMARK_CACHE_DIR, WATERMARK_CACHE_MAX_BYTES)
+
+
+def get_local_watermarked(photo, width):
+    """取得本機合成的浮水印圖 (先查磁碟快取，沒有才下載原圖合成)，失敗回傳 None"""
+    cache = get_watermark_cache()
+    data = cache.get(photo["public_id"], photo["url"], width)
+    if data is not None:
+        return data
+    try:
+        response = cloud_fetch(photo["url"], timeout=15)
+        response.raise_for_status()
+        data = render_local_watermark(response.content, width)
+    except Exception as e:
+        print(f"合成浮水印圖失敗 ({photo['public_id']}): {e}")
+        return None
+    cache.put(photo["public_id"], photo["url"], width, data)
+    return data
+
+
+def render_local_watermarks(photos, width, on_progress=None):
+    """
+    以執行緒池 (上限 WATERMARK_WORKERS) 批次取得多張照片的浮水印圖，
+    回傳 {public_id: JPEG 位元組或 None}。Pillow 解碼 / 縮放 / 合成時會釋放 GIL。
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=WATERMARK_WORKERS) as pool:
+        futures = {pool.submit(get_local_watermarked, p, width): p for p in photos}
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            results[futures[future]["public_id"]] = future.result()
+            if on_progress:
+                on_progress(done_count, len(futures))
+    return results
+
+
+def cached_local_watermarks(photos, width):
+    """只從磁碟快取取得已合成的浮水印圖 {public_id: JPEG 位元組}，不下載也不合成"""
+    cache = get_watermark_cache()
+    results = {}
+    for photo in photos:
+        data = cache.get(photo["public_id"], photo["url"], width)
+        if data is not None:
+            results[photo["public_id"]] = data
+    return results
+
+
+class WatermarkFiller:
+    """
+    在背景補齊磁碟快取中沒有的浮水印圖，分享頁不必等待下載與合成。
+    同一張圖 (public_id, 網址, 寬度) 排入後到完成前不會重複合成。
+    """
+
+    def __init__(self, max_workers=WATERMARK_WORKERS):
+        self.lock = threading.Lock()
+        self.pending = set()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="gallery-watermark"
+        )
+
+    def submit(self, photos, width):
+        """排入尚未在合成中的照片，回傳新排入的張數"""
+        queued = 0
+        with self.lock:
+            for photo in photos:
+                key = (photo["public_id"], photo["url"], width)
+                if key not in self.pending:
+                    self.pending.add(key)
+                    self._pool.submit(self._fill, photo, width, key)
+                    queued += 1
+        return queued
+
+    def _fill(self, photo, width, key):
+        try:
+            get_local_watermarked(photo, width)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+
+@st.cache_resource
+def get_watermark_filler():
+    return WatermarkFiller()
+
+
+def perceptual_hash(img):
+    """64-bit 差異雜湊 (dHash)：重新匯出、改名或改變壓縮率的同一張圖會得到相同或極接近的值"""
+    small = img.convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left < right)
+    return f"{bits:016x}"
+
+
+# dHash 漢明距離不超過此值即視為同一張圖 (重新壓縮 / 縮放通常只差 0~2 bit)
+NEAR_DUPLICATE_DISTANCE = 3
+
+
+# 「相似照片」搜尋的最大漢明距離與預設回傳張數 (線稿 / 彩色版本通常落在 10~20 bit)
+SIMILAR_MAX_DISTANCE = 20
+SIMILAR_TOP_K = 8
+
+
+def compute_content_hashes(data):
+    """回傳 (原始位元組的 SHA-256, 影像的 dHash)；無法解碼時 dHash 為 None"""
+    sha256 = hashlib.sha256(data).hexdigest()
+    try:
+        img = Image.open(BytesIO(data))
+        # 只需要極小的縮圖，JPEG 以 1/8 比例解碼即可
+        img.draft(img.mode, (64, 64))
+        img = ImageOps.exif_transpose(img)
+        phash = perceptual_hash(img)
+    except Exception:
+        phash = None
+    return sha256, phash
+
+
+def fetch_perceptual_hash(photo):
+    """下載小尺寸縮圖補算舊照片的 dHash"""
+    response = cloud_fetch(get_thumbnail_url(photo["url"], width=256), timeout=15)
+    response.raise_for_status()
+    img = ImageOps.exif_transpose(Image.open(BytesIO(response.content)))
+    return perceptual_hash(img)
+
+
+def backfill_perceptual_hashes(photos, on_progress=None):
+    """以執行緒池補算多張照片的 dHash，回傳 {public_id: dHash} (失敗的略過)"""
+    results = {}
+    with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+        futures = {pool.submit(fetch_perceptual_hash, p): p for p in photos}
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            try:
+                results[futures[future]["public_id"]] = future.result()
+            except Exception as e:
+                print(f"補算相似度雜湊失敗 ({futures[future]['public_id']}): {e}")
+            if on_progress:
+                on_progress(done_count, len(futures))
+    return results
+
+
+def parse_photo_date(filename):
+    """從檔名前 8 碼 (YYYYMMDD) 解析拍攝日期，失敗則使用今天"""
+    try:
+        return datetime.datetime.strptime(filename[:8], "%Y%m%d").date()
+    except Exception:
+        return datetime.date.today()
+
+
+def _failed_future(error):
+    """建立一個已失敗的 Future，讓上傳執行緒改走本地壓縮"""
+    future = Future()
+    future.set_exception(error)
+    return future
+
+
+def _upload_compressed(compress_future, raw_bytes):
+    """上傳執行緒：等待壓縮結果後上傳至 Cloudinary"""
+    try:
+        data, seconds = compress_future.result()
+    except Exception as e:
+        # 程序池無法使用 (例如無法建立子程序) 時，改在本執行緒內壓縮
+        print(f"程序池壓縮失敗，改在上傳執行緒內壓縮: {e!r}")
+        data, seconds = compress_image_bytes(raw_bytes)
+    record_timing("compress_image", seconds, len(raw_bytes))
+    res = cloud_upload(BytesIO(data), eager=EAGER_TRANSFORMATIONS)
+    return res, len(data)
+
+
+def eager_ready_transformations(upload_result):
+    """從上傳結果找出已成功預先產生的衍生圖 (Cloudinary 依請求順序回傳)"""
+    ready = []
+    for requested, derived in zip(EAGER_TRANSFORMATIONS, upload_result.get("eager", [])):
+        if derived.get("secure_url") or derived.get("url"):
+            ready.append(requested)
+    return ready
+
+
+def _submit_compress(data):
+    """
+    交給長駐程序池壓縮。程序池已損壞 (例如子程序被系統終止) 時重建一次，
+    仍無法使用則回傳失敗的 Future，由上傳執行緒自行壓縮。
+    """
+    error = None
+    for _ in range(2):
+        try:
+            pool = get_compress_pool(COMPRESS_WORKERS)
+        except Exception as e:
+            return _failed_future(e)
+        try:
+            return pool.submit(compress_image_bytes, data)
+        except BrokenExecutor as e:
+            discard_compress_pool(pool)
+            error = e
+        except Exception as e:
+            return _failed_future(e)
+    return _failed_future(error)
+
+
+def upload_files_parallel(items, on_progress=None):
+    """
+    有界並行上傳管線：壓縮交給長駐的程序池、上傳交給執行緒池 (上限 UPLOAD_CONCURRENCY)。
+    items 為 {"name", "data", ...} 字典，回傳同順序的 (項目, 上傳結果, 壓縮後大小, 錯誤) 清單。
+    """
+    payloads = [item["data"] for item in items]
+    results = [None] * len(items)
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as upload_pool:
+        upload_futures = {
+            upload_pool.submit(_upload_compressed, _submit_compress(data), data): i
+            for i, data in enumerate(payloads)
+        }
+
+        for done_count, future in enumerate(as_completed(upload_futures), start=1):
+            i = upload_futures[future]
+            try:
+                res, size = future.result()
+                results[i] = (items[i], res, size, None)
+            except Exception as e:
+                results[i] = (items[i], None, 0, e)
+            if on_progress:
+                on_progress(done_count, len(items), items[i], results[i][3])
+
+    return results
+
+
+def serialize_photo(item):
+    """轉成寫入雲端資料庫的 JSON 格式"""
+    return {
+        "public_id": item["public_id"],
+        "url": item["url"],
+        "name": item["name"],
+        "date_str": item["date"].isoformat(),
+        "tags": item["tags"],
+        "album": item.get("album", "未分類"),
+        "size": item.get("size", 0),
+        "eager": item.get("eager", []),
+        "sha256": item.get("sha256"),
+        "phash": item.get("phash"),
+    }
+
+
+def deserialize_photo(item):
+    """將雲端資料庫的 JSON 紀錄還原為程式內使用的格式"""
+    item["date"] = datetime.date.fromisoformat(item["date_str"])
+    if "album" not in item:
+        item["album"] = "未分類"
+    if "size" not in item:
+        item["size"] = 0
+    if "eager" not in item:
+        item["eager"] = []
+    item.setdefault("sha256", None)
+    item.setdefault("phash", None)
+    return item
+
+
+def apply_journal_ops(data, ops, albums=None):
+    """
+    將增量紀錄依序套用到照片清單 (重複套用結果不變)。
+    只載入部分相簿分片時以 albums 指定，新增到其他相簿的照片會略過。
+    """
+    photos = {item["public_id"]: item for item in data}
+    for op in ops:
+        kind = op["op"]
+        if kind == "add":
+            if albums is not None and op["photo"].get("album", "未分類") not in albums:
+                continue
+            photo = deserialize_photo(dict(op["photo"]))
+            photos[photo["public_id"]] = photo
+        elif kind == "update":
+            if op["public_id"] in photos:
+                photos[op["public_id"]].update(op["fields"])
+        elif kind == "delete":
+            for pid in op["public_ids"]:
+                photos.pop(pid, None)
+    data[:] = photos.values()
+    return data
+
+
+def _fetch_raw_json(public_id, bust_cache=False):
+    """
+    下載並解析雲端的 raw JSON 檔 (可為 gzip)。只有 404 代表檔案不存在而回傳 None，
+    其他狀態碼 (限流、5xx 等) 拋出例外，避免把讀取失敗誤當成空的資料庫。
+    """
+    url, options = cloudinary.utils.cloudinary_url(public_id, resource_type="raw")
+    if bust_cache:
+        url = f"{url}?t={time.time_ns()}"
+    response = cloud_fetch(url, timeout=10)
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError(f"讀取 {public_id} 失敗 (HTTP {response.status_code})")
+    body = response.content
+    if body[:2] == b"\x1f\x8b":  # gzip
+        body = gzip.decompress(body)
+    return json.loads(body)
+
+
+# v3 快照的欄位順序 (每欄一個清單)
+SNAPSHOT_COLUMNS = (
+    "public_id", "name", "date", "album", "tags", "size",
+    "url_version", "url_format", "eager", "sha256", "phash",
+)
+
+
+def _image_url_prefix():
+    return f"https://res.cloudinary.com/{cloudinary.config().cloud_name}/image/upload/"
+
+
+def encode_snapshot(data, version=0, writer=None):
+    """
+    將照片清單編碼成 v3 欄式快照 (gzip 壓縮的 JSON)：日期存成 ordinal 整數，
+    相簿 / 標籤 / 副檔名 / eager 組合以字典編碼，網址只存版本號，
+    由 public_id 還原 (不符合標準格式的網址另外原樣保存)。
+    """
+    prefix = _image_url_prefix()
+    albums, tags, formats, eager_sets = {}, {}, {}, {}
+    url_overrides = {}
+    columns = {key: [] for key in SNAPSHOT_COLUMNS}
+    for i, item in enumerate(data):
+        pid, url = item["public_id"], item["url"]
+        url_version, url_format = 0, 0
+        version_part, _, tail = url[len(prefix) :].partition("/")
+        if (
+            url.startswith(prefix)
+            and version_part[:1] == "v"
+            and version_part[1:].isdigit()
+            and tail.startswith(pid + ".")
+            and "/" not in tail[len(pid) + 1 :]
+        ):
+            url_version = int(version_part[1:])
+            url_format = formats.setdefault(tail[len(pid) + 1 :], len(formats))
+        else:
+            url_overrides[str(i)] = url
+
+        columns["public_id"].append(pid)
+        columns["name"].append(item["name"])
+        columns["date"].append(item["date"].toordinal())
+        columns["album"].append(albums.setdefault(item.get("album", "未分類"), len(albums)))
+        columns["tags"].append([tags.setdefault(t, len(tags)) for t in item["tags"]])
+        columns["size"].append(item.get("size", 0))
+        columns["url_version"].append(url_version)
+        columns["url_format"].append(url_format)
+        eager = tuple(item.get("eager", []))
+        columns["eager"].append(eager_sets.setdefault(eager, len(eager_sets)))
+        columns["sha256"].append(item.get("sha256"))
+        columns["phash"].append(item.get("phash"))
+
+    snapshot = {
+        "format": 3,
+        "version": version,
+        "writer": writer,
+        "url_prefix": prefix,
+        "albums": list(albums),
+        "tags": list(tags),
+        "url_formats": list(formats),
+        "eager_sets": [list(e) for e in eager_sets],
+        "url_overrides": url_overrides,
+        "columns": columns,
+    }
+    body = json.dumps(snapshot, ensure_ascii=False, separators=(",", ":"))
+    # mtime=0 讓相同內容產生相同位元組，分片才能以內容雜湊命名
+    return gzip.compress(body.encode("utf-8"), compresslevel=6, mtime=0)
+
+
+def decode_snapshot(snapshot):
+    """將 v3 欄式快照還原為程式內使用的照片清單"""
+    prefix = snapshot["url_prefix"]
+    albums, tags = snapshot["albums"], snapshot["tags"]
+    formats = snapshot["url_formats"]
+    eager_sets = snapshot["eager_sets"]
+    url_overrides = snapshot["url_overrides"]
+    columns = snapshot["columns"]
+    from_ordinal = datetime.date.fromordinal
+    photos = []
+    rows = zip(*(columns[key] for key in SNAPSHOT_COLUMNS))
+    for i, row in enumerate(rows):
+        pid, name, date, album, tag_codes, size, url_version, url_format, eager, sha256, phash = row
+        url = url_overrides.get(str(i)) if url_overrides else None
+        photos.append(
+            {
+                "public_id": pid,
+                "url": url or f"{prefix}v{url_version}/{pid}.{formats[url_format]}",
+                "name": name,
+                "date": from_ordinal(date),
+                "tags": [tags[t] for t in tag_codes],
+                "album": albums[album],
+                "size": size,
+                "eager": list(eager_sets[eager]),
+                "sha256": sha256,
+                "phash": phash,
+            }
+        )
+    return photos
+
+
+def list_journal_ids():
+    """列出雲端上的增量紀錄 (依時間排序，包含已壓實、等待清除的紀錄)"""
+    journal_ids = []
+    next_cursor = None
+    while True:
+        kwargs = {"next_cursor": next_cursor} if next_cursor else {}
+        result = cloudinary.api.resources(
+            resource_type="raw",
+            type="upload",
+            prefix=DB_JOURNAL_PREFIX,
+            max_results=500,
+            **kwargs,
+        )
+        journal_ids.extend(r["public_id"] for r in result.get("resources", []))
+        next_cursor = result.get("next_cursor")
+        if not next_cursor:
+            break
+    return sorted(journal_ids)
+
+
+@contextmanager
+def paused_gc():
+    """
+    解析快照與建立索引時會建立數十萬個小物件，暫停循環垃圾回收避免反覆掃描
+    (5 萬張約省下一半時間)。
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _bump(counts, key, delta):
+    """計數加減，歸零的鍵直接移除"""
+    value = counts.get(key, 0) + delta
+    if value:
+        counts[key] = value
+    else:
+        counts.pop(key, None)
+
+
+class AlbumStats:
+    """
+    單一相簿的統計彙總：張數、未分類張數、容量、各年月張數、各標籤使用次數
+    與各標籤的逐年張數。隨照片加入 / 移除增量更新，讀取時不必掃描照片。
+    """
+
+    __slots__ = ("count", "untagged", "size", "months", "tags", "tag_years")
+
+    def __init__(self):
+        self.count = 0
+        self.untagged = 0
+        self.size = 0
+        self.months = {}
+        self.tags = {}
+        self.tag_years = {}
+
+    @classmethod
+    def from_entries(cls, entries):
+        """由 (標籤, 年, 月, 容量) 清單一次建立 (大量載入時比逐張 apply 快)"""
+        stats = cls()
+        stats.count = len(entries)
+        stats.size = sum(entry[3] for entry in entries)
+        stats.months = dict(Counter(year * 100 + month for _, year, month, _ in entries))
+        stats.untagged = sum(1 for entry in entries if not entry[0])
+        tag_years = Counter(
+            (tag, year) for tags, year, _, _ in entries for tag in tags
+        )
+        for (tag, year), n in tag_years.items():
+            stats.tags[tag] = stats.tags.get(tag, 0) + n
+            stats.tag_years.setdefault(tag, {})[year] = n
+        return stats
+
+    def apply(self, tags, year, month, size, sign=1):
+        """加入 (sign=1) 或移除 (sign=-1) 一張照片；tags 需已去除重複"""
+        self.count += sign
+        self.size += sign * size
+        # 內部以整數 (年 * 100 + 月 / 年) 為鍵，輸出摘要時才轉成字串
+        _bump(self.months, year * 100 + month, sign)
+        if not tags:
+            self.untagged += sign
+        for tag in tags:
+            _bump(self.tags, tag, sign)
+            years = self.tag_years.get(tag)
+            if years is None:
+                years = self.tag_years[tag] = {}
+            _bump(years, year, sign)
+            if not years:
+                del self.tag_years[tag]
+
+    def summary(self):
+        """摘要 dict (與 manifest 中的格式相同)"""
+        return {
+            "count": self.count,
+            "untagged": self.untagged,
+            "size": self.size,
+            "months": {
+                f"{key // 100}-{key % 100:02d}": n for key, n in self.months.items()
+            },
+            "tags": dict(self.tags),
+            "tag_years": {
+                tag: {str(year): n for year, n in years.items()}
+                for tag, years in self.tag_years.items()
+            },
+        }
+
+
+def album_summary(photos):
+    """相簿統計摘要 (寫入 manifest 用)"""
+    return AlbumStats.from_entries(
+        [
+            (tuple(dict.fromkeys(p["tags"])), p["date"].year, p["date"].month, p.get("size", 0))
+            for p in photos
+        ]
+    ).summary()
+
+
+def combine_summaries(summaries):
+    """合併多個相簿摘要"""
+    total = {"count": 0, "untagged": 0, "size": 0, "months": {}, "tags": {}, "tag_years": {}}
+    for summary in summaries:
+        for key in ("count", "untagged", "size"):
+            total[key] += summary[key]
+        for key in ("months", "tags"):
+            for name, count in summary[key].items():
+                _bump(total[key], name, count)
+        for tag, years in summary.get("tag_years", {}).items():
+            for year, count in years.items():
+                _bump(total["tag_years"].setdefault(tag, {}), year, count)
+    return total
+
+
+def ops_albums(ops):
+    """增量紀錄影響到的相簿集合；舊紀錄沒有記錄相簿時回傳 None (視為全部)"""
+    albums = set()
+    for op in ops:
+        if op["op"] == "add":
+            albums.add(op["photo"].get("album", "未分類"))
+        elif "albums" in op:
+            albums.update(op["albums"])
+        else:
+            return None
+    return albums
+
+
+def fetch_manifest():
+    """讀取分片格式的 manifest；雲端還沒有 manifest (舊版快照) 時回傳 None"""
+    return _fetch_raw_json(DB_MANIFEST_FILENAME, bust_cache=True)
+
+
+def fetch_snapshot():
+    """
+    讀取尚未分片的舊版快照 (v3 欄式，或 v2 的照片清單 / 含版本號的 dict)。
+    只在 manifest 確實不存在 (404) 時呼叫；兩者都不存在代表圖庫是空的。
+    """
+    snapshot = _fetch_raw_json(DB_SNAPSHOT_FILENAME, bust_cache=True)
+    if snapshot is not None:
+        return snapshot
+    return _fetch_raw_json(DB_FILENAME, bust_cache=True)
+
+
+def snapshot_header(snapshot):
+    """回傳快照或 manifest 的 (版本, 寫入者)；舊版照片清單視為第 0 版"""
+    if isinstance(snapshot, dict):
+        return snapshot.get("version", 0), snapshot.get("writer")
+    return 0, None
+
+
+def snapshot_photos(snapshot):
+    """將任一版本的單一快照還原為照片清單"""
+    if snapshot is None:
+        return []
+    if isinstance(snapshot, list):
+        return [deserialize_photo(item) for item in snapshot]
+    if snapshot.get("format") == 3:
+        return decode_snapshot(snapshot)
+    return [deserialize_photo(item) for item in snapshot.get("photos", [])]
+
+
+@instrumented("load_shards")
+def load_shards(manifest, albums, cache=None):
+    """
+    平行下載並解碼指定相簿的分片 (依 manifest 順序串接)。
+    分片以內容雜湊命名、內容不會變動，cache 中已有的直接取用不重新下載。
+    """
+    files = [
+        manifest["shards"][album]["file"]
+        for album in manifest["shards"]
+        if album in albums
+    ]
+    cache = {} if cache is None else cache
+    missing = [f for f in files if f not in cache]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for file_id, snapshot in zip(missing, pool.map(_fetch_raw_json, missing)):
+            if snapshot is None:
+                raise RuntimeError(f"找不到資料庫分片 {file_id}")
+            cache[file_id] = snapshot
+    return [photo for f in files for photo in decode_snapshot(cache[f])]
+
+
+def load_journal(compacted=()):
+    """
+    讀取尚未壓實的增量紀錄 (略過 manifest 記錄為已併入快照的 compacted)，
+    回傳 (增量紀錄 ID 清單, 依序串接的異動)。
+    列出或下載失敗時直接拋出例外：少了增量紀錄的快照不能當成雲端的最新狀態。
+    """
+    journal_ids = [j for j in list_journal_ids() if j not in compacted]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        entries = list(pool.map(_fetch_raw_json, journal_ids))
+    return journal_ids, [op for entry in entries if entry for op in entry["ops"]]
+
+
+@instrumented("load_db")
+def load_db(shard_cache=None):
+    """
+    載入完整圖庫 (所有分片) 並重播增量紀錄。
+    回傳 (照片清單, 已套用的增量紀錄 ID 清單, 快照版本, manifest)；
+    雲端仍是舊版單一快照時 manifest 為 None，連線失敗時照片清單為 None。
+    """
+    try:
+        manifest = fetch_manifest()
+        if manifest is not None:
+            version, _ = snapshot_header(manifest)
+            with paused_gc():
+                data = load_shards(manifest, manifest["shards"], shard_cache)
+        else:
+            with paused_gc():
+                snapshot = fetch_snapshot()
+                version, _ = snapshot_header(snapshot)
+                data = snapshot_photos(snapshot)
+        compacted = manifest.get("compacted", {}) if manifest is not None else ()
+        journal_ids, ops = load_journal(compacted)
+    except Exception as e:
+        print(f"載入資料庫失敗: {e}")
+        return None, [], 0, None
+
+    apply_journal_ops(data, ops)
+    return data, journal_ids, version, manifest
+
+
+def _upload_raw(payload, public_id):
+    cloud_upload(
+        BytesIO(payload),
+        public_id=public_id,
+        resource_type="raw",
+        overwrite=True,
+        invalidate=True,
+    )
+
+
+@instrumented("save_db")
+def save_db(data, version=0, writer=None, retired=None, compacted=None):
+    """
+    將完整圖庫依相簿分片寫成第 version 版快照：先上傳所有分片，
+    最後寫入 manifest (writer 用來確認寫入未被覆蓋)。
+    分片即使雲端已有同名檔案也重新上傳：它可能正被其他程序的壓實清除。
+    retired 為 {停用的分片檔名: 停用時間}，compacted 為 {已併入快照的增量紀錄 ID: 壓實時間}，
+    都記錄在 manifest 中由之後的壓實清除 (本次仍引用的分片會從 retired 排除)；
+    載入時略過 compacted 中的增量紀錄。成功回傳寫入的 manifest，失敗回傳 None。
+    """
+    by_album = defaultdict(list)
+    for item in data:
+        by_album[item.get("album", "未分類")].append(item)
+
+    shards = {}
+    payloads = {}
+    for album in sorted(by_album):
+        photos = by_album[album]
+        payload = encode_snapshot(photos)
+        file_id = f"{DB_SHARD_PREFIX}{hashlib.sha256(payload).hexdigest()[:24]}.json.gz"
+        shards[album] = {"file": file_id, "summary": album_summary(photos)}
+        payloads[file_id] = payload
+
+    manifest = {
+        "format": 4,
+        "version": version,
+        "writer": writer,
+        "shards": shards,
+        "retired": {
+            f: ts for f, ts in (retired or {}).items() if f not in payloads
+        },
+        "compacted": dict(compacted or {}),
+    }
+    try:
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+            list(pool.map(_upload_raw, payloads.values(), payloads.keys()))
+        _upload_raw(
+            json.dumps(manifest, ensure_ascii=False).encode("utf-8"),
+            DB_MANIFEST_FILENAME,
+        )
+        return manifest
+    except Exception as e:
+        st.error(f"資料庫同步雲端失敗: {e}")
+        return None
+
+
+def merge_photo_lists(base, ours, theirs):
+    """
+    三方合併：以 public_id 對齊、逐欄位比較。只有一方修改的欄位採用該方，
+    雙方改成不同值時以本程序 (ours) 為準；任一方刪除的照片一律刪除
+    (雲端圖片已不存在)。base 為 {public_id: 序列化紀錄}，回傳合併後的照片清單。
+    """
+    ours_map = {p["public_id"]: serialize_photo(p) for p in ours}
+    theirs_map = {p["public_id"]: serialize_photo(p) for p in theirs}
+    merged = []
+    for pid in list(ours_map) + [pid for pid in theirs_map if pid not in ours_map]:
+        mine, other, original = ours_map.get(pid), theirs_map.get(pid), base.get(pid)
+        if original is not None and (mine is None or other is None):
+            continue
+        if mine is None:
+            record = other
+        elif other is None:
+            record = mine
+        else:
+            record = dict(other)
+            for field, value in mine.items():
+                if original is None or value != original.get(field):
+                    record[field] = value
+        merged.append(deserialize_photo(dict(record)))
+    return merged
+
+
+def _popcount64(values):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    # numpy 2.0 以前沒有 bitwise_count，改用逐位元組查表
+    return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class HammingIndex:
+    """
+    64-bit dHash 的緊密陣列索引，一次以向量運算算出與所有照片的漢明距離
+    (5 萬張約 1ms)。刪除時把最後一筆搬到空位，陣列保持連續。
+    """
+
+    def __init__(self):
+        self._hashes = np.zeros(1024, dtype=np.uint64)
+        self._ids = []
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, phash, public_id):
+        value = np.uint64(int(phash, 16))
+        position = self._positions.get(public_id)
+        if position is not None:
+            self._hashes[position] = value
+            return
+        size = len(self._ids)
+        if size == len(self._hashes):
+            self._hashes = np.concatenate([self._hashes, np.zeros(size, dtype=np.uint64)])
+        self._hashes[size] = value
+        self._ids.append(public_id)
+        self._positions[public_id] = size
+
+    def extend(self, items):
+        """一次加入多筆 (dHash, public_id)，避免逐筆寫入 numpy 陣列 (載入整個圖庫時使用)"""
+        new_items = []
+        for phash, public_id in items:
+            if public_id in self._positions:
+                self.add(phash, public_id)
+            else:
+                new_items.append((phash, public_id))
+        if not new_items:
+            return
+        size = len(self._ids)
+        values = np.array([int(phash, 16) for phash, _ in new_items], dtype=np.uint64)
+        needed = size + len(values)
+        if needed > len(self._hashes):
+            grown = np.zeros(max(needed, 2 * len(self._hashes)), dtype=np.uint64)
+            grown[:size] = self._hashes[:size]
+            self._hashes = grown
+        self._hashes[size:needed] = values
+        for offset, (_, public_id) in enumerate(new_items):
+            self._ids.append(public_id)
+            self._positions[public_id] = size + offset
+
+    def remove(self, public_id):
+        position = self._positions.pop(public_id, None)
+        if position is None:
+            return
+        last = len(self._ids) - 1
+        if position != last:
+            moved_id = self._ids[last]
+            self._hashes[position] = self._hashes[last]
+            self._ids[position] = moved_id
+            self._positions[moved_id] = position
+        self._ids.pop()
+
+    def nearest(self, phash, k=SIMILAR_TOP_K, max_distance=SIMILAR_MAX_DISTANCE, exclude=()):
+        """回傳距離不超過 max_distance 且最近的 k 筆 (距離, public_id)，同距離依 ID 排序"""
+        size = len(self._ids)
+        if size == 0:
+            return []
+        distances = _popcount64(self._hashes[:size] ^ np.uint64(int(phash, 16)))
+        candidates = np.flatnonzero(distances <= max_distance)
+        limit = k + len(exclude)
+        if len(candidates) > limit:
+            # 先以 argpartition 取出最近的一批，再對這一小批做完整排序
+            nearest = np.argpartition(distances[candidates], limit - 1)[:limit]
+            cutoff = distances[candidates[nearest]].max()
+            candidates = candidates[distances[candidates] <= cutoff]
+        matches = sorted(
+            (int(distances[i]), self._ids[i])
+            for i in candidates
+            if self._ids[i] not in exclude
+        )
+        return matches[:k]
+
+
+class GalleryIndex:
+    """
+    相簿 / 標籤 / 年份 / 月份的倒排索引，每個鍵對應一組 public_id。
+    篩選時只做集合交集與差集，不必逐張掃描照片。
+    """
+
+    def __init__(self, photos=()):
+        self.all_ids = set()
+        self.untagged = set()
+        self.by_album = defaultdict(set)
+        self.by_tag = defaultdict(set)
+        self.by_year = defaultdict(set)
+        self.by_month = defaultdict(set)
+        # 各相簿的統計彙總，與倒排索引同步增量更新
+        self.stats = {}
+        # public_id -> 建索引時的 (相簿, 標籤, 年, 月, 容量)，讓照片被原地修改後仍能正確移除
+        self._entries = {}
+        self.extend(photos)
+
+    def add(self, photo):
+        entry = self._add(photo)
+        stats = self.stats.get(entry[0])
+        if stats is None:
+            stats = self.stats[entry[0]] = AlbumStats()
+        stats.apply(*entry[1:])
+
+    def extend(self, photos):
+        """大量加入照片，新相簿的統計彙總一次建立"""
+        added = defaultdict(list)
+        for photo in {p["public_id"]: p for p in photos}.values():
+            if photo["public_id"] in self._entries:
+                self.add(photo)
+            else:
+                entry = self._add(photo)
+                added[entry[0]].append(entry[1:])
+        for album, entries in added.items():
+            stats = self.stats.get(album)
+            if stats is None:
+                self.stats[album] = AlbumStats.from_entries(entries)
+            else:
+                for entry in entries:
+                    stats.apply(*entry)
+
+    def _add(self, photo):
+        """加入倒排索引 (不含統計彙總)，回傳索引項目"""
+        pid = photo["public_id"]
+        if pid in self._entries:
+            self.remove(pid)
+        tags = tuple(dict.fromkeys(photo.get("tags", [])))
+        entry = (
+            photo["album"],
+            tags,
+            photo["date"].year,
+            photo["date"].month,
+            photo.get("size", 0),
+        )
+        self._entries[pid] = entry
+        self.all_ids.add(pid)
+        self.by_album[entry[0]].add(pid)
+        self.by_year[entry[2]].add(pid)
+        self.by_month[entry[3]].add(pid)
+        if tags:
+            for tag in tags:
+                self.by_tag[tag].add(pid)
+        else:
+            self.untagged.add(pid)
+        return entry
+
+    def remove(self, public_id):
+        entry = self._entries.pop(public_id, None)
+        if entry is None:
+            return
+        album, tags, year, month, size = entry
+        stats = self.stats[album]
+        stats.apply(tags, year, month, size, sign=-1)
+        if not stats.count:
+            del self.stats[album]
+        self.all_ids.discard(public_id)
+        self.untagged.discard(public_id)
+        self._discard(self.by_album, album, public_id)
+        self._discard(self.by_year, year, public_id)
+        self._discard(self.by_month, month, public_id)
+        for tag in tags:
+            self._discard(self.by_tag, tag, public_id)
+
+    def reindex(self, photo):
+        """照片的標籤或相簿被修改後重新建立該張的索引"""
+        self.add(photo)
+
+    @staticmethod
+    def _discard(postings, key, public_id):
+        ids = postings.get(key)
+        if ids is not None:
+            ids.discard(public_id)
+            if not ids:
+                del postings[key]
+
+    def query(
+        self,
+        album=None,
+        year=None,
+        months=None,
+        include_tags=(),
+        exclude_tags=(),
+        untagged_only=False,
+    ):
+        """回傳符合所有條件的 public_id 集合 (None / 空值代表不限)"""
+        empty = set()
+        postings = []
+        if album is not None:
+            postings.append(self.by_album.get(album, empty))
+        if year is not None:
+            postings.append(self.by_year.get(year, empty))
+        if months and len(set(months)) < 12:
+            postings.append(
+                set().union(*(self.by_month.get(m, empty) for m in months))
+            )
+        if untagged_only:
+            postings.append(self.untagged)
+        else:
+            postings.extend(self.by_tag.get(tag, empty) for tag in include_tags)
+
+        if not postings:
+            result = set(self.all_ids)
+        else:
+            # 由最小的集合開始交集，減少比對次數
+            postings.sort(key=len)
+            result = set(postings[0]).intersection(*postings[1:])
+
+        if not untagged_only:
+            for tag in exclude_tags:
+                result -= self.by_tag.get(tag, empty)
+        return result
+
+
+class PhotoRepository:
+    """
+    以 public_id 為鍵的照片庫：有序清單 photos 與字典 by_id 永遠同步，
+    所有新增 / 修改 / 刪除都經過這裡，並同時更新倒排索引。
+    異動方法會回傳對應的增量紀錄 (op)，直接交給 record_changes 同步雲端。
+    """
+
+    INDEXED_FIELDS = {"tags", "album", "date", "size"}
+
+    def __init__(self, photos=()):
+        self.lock = threading.RLock()
+        self.photos = []
+        self.by_id = {}
+        self.index = GalleryIndex()
+        # public_id -> 加入順序，用來在不掃描整個清單的情況下還原原始排序
+        self._seq = {}
+        self._next_seq = 0
+        # 重複檢查用：檔名 / 原始檔 SHA-256 -> public_id 集合
+        self._by_key = {"name": {}, "sha256": {}}
+        # 影像 dHash 索引 (近似重複檢查與相似照片搜尋)，以及尚未計算 dHash 的照片
+        self.similarity = HammingIndex()
+        self.missing_phash = set()
+        self.replace_all(photos)
+
+    def __len__(self):
+        return len(self.photos)
+
+    def __contains__(self, public_id):
+        return public_id in self.by_id
+
+    def get(self, public_id):
+        return self.by_id.get(public_id)
+
+    def replace_all(self, photos):
+        """
+        整批替換內容。索引先在新的物件上建好再一次換上，背景重新載入時，
+        正在繪製頁面的執行緒不會讀到建到一半的資料。
+        """
+        fresh = PhotoRepository.__new__(PhotoRepository)
+        fresh.photos = list(photos)
+        fresh.by_id = {}
+        fresh._seq = {}
+        fresh._next_seq = 0
+        fresh._by_key = {"name": {}, "sha256": {}}
+        fresh.similarity = HammingIndex()
+        fresh.missing_phash = set()
+        hashes = []
+        for photo in fresh.photos:
+            fresh._track(photo, hashes)
+        fresh.similarity.extend(hashes)
+        fresh.index = GalleryIndex(fresh.photos)
+        with self.lock:
+            self.by_id = fresh.by_id
+            self._seq = fresh._seq
+            self._next_seq = fresh._next_seq
+            self._by_key = fresh._by_key
+            self.similarity = fresh.similarity
+            self.missing_phash = fresh.missing_phash
+            self.index = fresh.index
+            self.photos[:] = fresh.photos
+
+    def _track(self, photo, hashes=None):
+        self.by_id[photo["public_id"]] = photo
+        self._seq[photo["public_id"]] = self._next_seq
+        self._next_seq += 1
+        self._index_keys(photo, hashes)
+
+    def _index_keys(self, photo, hashes=None):
+        """hashes 不為 None 時先收集 dHash，由呼叫端一次批次加入相似度索引"""
+        pid = photo["public_id"]
+        for field, lookup in self._by_key.items():
+            value = photo.get(field)
+            if value:
+                lookup.setdefault(value, set()).add(pid)
+        if photo.get("phash"):
+            if hashes is None:
+                self.similarity.add(photo["phash"], pid)
+            else:
+                hashes.append((photo["phash"], pid))
+            self.missing_phash.discard(pid)
+        else:
+            self.missing_phash.add(pid)
+
+    def _unindex_keys(self, photo):
+        pid = photo["public_id"]
+        for field, lookup in self._by_key.items():
+            ids = lookup.get(photo.get(field))
+            if ids is not None:
+                ids.discard(pid)
+                if not ids:
+                    del lookup[photo.get(field)]
+        if photo.get("phash"):
+            self.similarity.remove(pid)
+        self.missing_phash.discard(pid)
+
+    def find_near_duplicate(self, phash, max_distance=NEAR_DUPLICATE_DISTANCE):
+        """回傳 dHash 漢明距離最小 (且不超過 max_distance) 的照片，沒有則回傳 None"""
+        with self.lock:
+            matches = self.similarity.nearest(phash, k=1, max_distance=max_distance)
+            return self.by_id[matches[0][1]] if matches else None
+
+    def find_similar(self, public_id, k=SIMILAR_TOP_K, max_distance=SIMILAR_MAX_DISTANCE):
+        """回傳與指定照片最相似的 k 張照片 [(距離, 照片)]"""
+        with self.lock:
+            photo = self.by_id.get(public_id)
+            if photo is None or not photo.get("phash"):
+                return []
+            matches = self.similarity.nearest(
+                photo["phash"], k=k, max_distance=max_distance, exclude={public_id}
+            )
+            return [(distance, self.by_id[pid]) for distance, pid in matches]
+
+    def find_duplicate(self, name, sha256=None, phash=None):
+        """
+        依序以內容完全相同、影像相似、檔名相同檢查是否已在圖庫中 (皆為 O(1) 查詢)。
+        回傳 (原因, 既有照片)，沒有重複時回傳 None。
+        """
+        with self.lock:
+            ids = self._by_key["sha256"].get(sha256) if sha256 else None
+            if ids:
+                return "內容完全相同", self.by_id[next(iter(ids))]
+            if phash:
+                similar = self.find_near_duplicate(phash)
+                if similar is not None:
+                    return "影像相似", similar
+            ids = self._by_key["name"].get(name)
+            if ids:
+                return "檔名相同", self.by_id[next(iter(ids))]
+            return None
+
+    def add(self, photos):
+        """新增照片 (依傳入順序加在最後)，回傳增量紀錄清單"""
+        return [{"op": "add", "photo": serialize_photo(p)} for p in self.extend(photos)]
+
+    def extend(self, photos):
+        """加入照片但不產生增量紀錄 (載入資料庫分片時使用)，回傳實際加入的照片"""
+        added = []
+        hashes = []
+        with self.lock:
+            for photo in photos:
+                if photo["public_id"] in self.by_id:
+                    continue
+                self.photos.append(photo)
+                self._track(photo, hashes)
+                added.append(photo)
+            self.similarity.extend(hashes)
+            self.index.extend(added)
+        return added
+
+    def update(self, public_id, **fields):
+        """修改單張照片欄位，回傳增量紀錄；找不到照片時回傳 None"""
+        with self.lock:
+            photo = self.by_id.get(public_id)
+            if photo is None:
+                return None
+            # 記下所屬相簿 (含搬移前後)，只載入部分分片時才知道要套用到哪些相簿
+            albums = {photo["album"], fields.get("album", photo["album"])}
+            self._unindex_keys(photo)
+            photo.update(fields)
+            self._index_keys(photo)
+            if self.INDEXED_FIELDS & fields.keys():
+                self.index.reindex(photo)
+        return {
+            "op": "update",
+            "public_id": public_id,
+            "fields": fields,
+            "albums": sorted(albums),
+        }
+
+    def remove(self, public_ids):
+        """刪除多張照片 (單次掃描重建清單)，回傳增量紀錄"""
+        with self.lock:
+            doomed = {pid for pid in public_ids if pid in self.by_id}
+            albums = {self.by_id[pid]["album"] for pid in doomed}
+            for pid in doomed:
+                self._unindex_keys(self.by_id[pid])
+                del self.by_id[pid]
+                del self._seq[pid]
+                self.index.remove(pid)
+            if doomed:
+                self.photos[:] = [
+                    p for p in self.photos if p["public_id"] not in doomed
+                ]
+        return {"op": "delete", "public_ids": sorted(doomed), "albums": sorted(albums)}
+
+    def album_stats(self, album):
+        """相簿的統計摘要 (由索引增量維護的彙總直接取得)"""
+        with self.lock:
+            stats = self.index.stats.get(album)
+            return stats.summary() if stats is not None else AlbumStats().summary()
+
+    def select(self, public_ids):
+        """依圖庫原始順序取出指定的照片 (成本只和選取數量有關)"""
+        with self.lock:
+            ids = [pid for pid in public_ids if pid in self.by_id]
+            ids.sort(key=self._seq.__getitem__)
+            return [self.by_id[pid] for pid in ids]
+
+
+class SharedGallery:
+    """
+    伺服器程序內所有 session 共用的圖庫快取。
+    照片庫 (repo) 會被原地更新，各 session 直接引用同一份資料；
+    version 在每次異動或重新載入時遞增，供各 session 判斷資料是否已變更。
+    """
+
+    # 會影響選單清單 (相簿 / 標籤 / 年份) 的照片欄位
+    OPTION_FIELDS = {"album", "tags", "date"}
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.repo = PhotoRepository()
+        self.journal_ids = []
+        self.base = {}
+        self.base_version = 0
+        self.version = 0
+        self.loaded = False
+        self.checked_at = 0.0
+        self.head_etag = None
+        self.head_token = None
+        # 上次重新載入失敗 (雲端讀取錯誤) 時，下次檢查不論版本標記都要重新載入
+        self.reload_failed = False
+        # 尚未上傳的異動 (延遲合併寫入)，以及序列化上傳用的鎖與排程中的計時器
+        self.pending_ops = []
+        self.flush_lock = threading.Lock()
+        self.flush_timer = None
+        # 分片載入狀態：目前的 manifest、下載過的分片 (以檔名快取)、已載入的相簿，
+        # 是否已載入全部相簿，以及尚未壓實的增量紀錄內容 (載入其他分片時要再套用)
+        self.manifest = None
+        self.shard_cache = {}
+        self.loaded_albums = set()
+        self.complete = False
+        self.journal_ops = []
+        # 本程序上次壓實時確認已從雲端刪除的舊分片與增量紀錄，下次寫入 manifest 時從清單移除
+        self.purged = set()
+        # 選單用的相簿 / 標籤 / 年份清單快取：options_version 只在可能改變這些清單的
+        # 異動 (新增、刪除、修改相簿 / 標籤 / 日期、重新載入) 時遞增
+        self.options_version = 0
+        self._options_key = None
+        self._options = None
+
+    def sync(self):
+        """首次使用時載入資料庫，之後每隔 DB_REFRESH_INTERVAL 秒做一次條件式檢查"""
+        with self.lock:
+            if not self.loaded:
+                self._reload()
+            elif time.time() - self.checked_at >= DB_REFRESH_INTERVAL:
+                self._check_remote()
+
+    @instrumented("load_db")
+    def _reload(self):
+        """
+        載入 manifest 與增量紀錄；只重新載入目前已載入的相簿分片
+        (內容未變的分片直接取用快取)，其他相簿等到頁面需要時才下載。
+        """
+        # 先記下版本標記再載入，確保載入期間的新寫入會在下次檢查時被發現
+        self._fetch_head(conditional=False)
+        try:
+            manifest = fetch_manifest()
+        except Exception as e:
+            print(f"讀取資料庫 manifest 失敗: {e}")
+            self._retry_reload()
+            return
+        needs_migration = False
+        if manifest is None:
+            # 雲端仍是舊版單一快照：整份載入，並在背景遷移成分片格式
+            data, journal_ids, version, _ = load_db()
+            if data is None:
+                self._retry_reload()
+                return
+            journal_ops = []
+            albums = None
+            needs_migration = bool(data)
+        else:
+            try:
+                journal_ids, journal_ops = load_journal(manifest.get("compacted", {}))
+            except Exception as e:
+                print(f"讀取增量紀錄失敗: {e}")
+                self._retry_reload()
+                return
+            version, _ = snapshot_header(manifest)
+            # 有搬移相簿的異動時無法只套用到部分分片，改為全部載入
+            moves_album = any(
+                op["op"] == "update" and "album" in op["fields"] for op in journal_ops
+            )
+            albums = None if self.complete or moves_album else set(self.loaded_albums)
+            try:
+                with paused_gc():
+                    data = load_shards(
+                        manifest,
+                        manifest["shards"] if albums is None else albums,
+                        self.shard_cache,
+                    )
+            except Exception as e:
+                print(f"載入資料庫分片失敗: {e}")
+                self._retry_reload()
+                return
+            apply_journal_ops(data, journal_ops, albums)
+            # 只保留目前 manifest 引用的分片快取
+            current_files = {info["file"] for info in manifest["shards"].values()}
+            for file_id in set(self.shard_cache) - current_files:
+                del self.shard_cache[file_id]
+
+        # 三方合併的共同基準：最後一次與雲端同步時的內容
+        self.base = {p["public_id"]: serialize_photo(p) for p in data}
+        self.base_version = version
+        if not self.loaded:
+            # 上次程序中斷前未上傳的異動，載入後補傳
+            self.pending_ops[:] = read_pending_spool()
+            if self.pending_ops:
+                schedule_flush(self)
+        # 本機尚未上傳的異動疊加在雲端資料上，重新載入時才不會遺失
+        apply_journal_ops(data, self.pending_ops, albums)
+        with paused_gc():
+            self.repo.replace_all(data)
+        self.journal_ids[:] = journal_ids
+        self.journal_ops = journal_ops
+        self.manifest = manifest
+        self.complete = albums is None
+        if albums is not None:
+            self.loaded_albums = albums
+        if needs_migration:
+            # 在背景寫出分片快照，之後的載入改讀新格式
+            threading.Thread(
+                target=compact_db, args=(self.repo.photos,), daemon=True
+            ).start()
+        self.loaded = True
+        self.reload_failed = False
+        self.version += 1
+        self.options_version += 1
+        self.checked_at = time.time()
+
+    def _retry_reload(self):
+        """載入失敗時保留目前的圖庫，標記下次檢查 (DB_REFRESH_INTERVAL 秒後) 必須重新載入"""
+        self.reload_failed = True
+        self.checked_at = time.time()
+
+    def known_albums(self):
+        """所有相簿：manifest 中的分片、尚未壓實的新增紀錄，以及已載入的照片"""
+        with self.lock:
+            albums = set(self.manifest["shards"]) if self.manifest else set()
+            for op in self.journal_ops + self.pending_ops:
+                if op["op"] == "add":
+                    albums.add(op["photo"].get("album", "未分類"))
+            albums.update(album for album, ids in self.repo.index.by_album.items() if ids)
+            return albums
+
+    def has_albums(self, albums=None):
+        """指定相簿 (None 為全部) 是否都已載入"""
+        return self.complete or (albums is not None and set(albums) <= self.loaded_albums)
+
+    def ensure_albums(self, albums=None):
+        """確保指定相簿 (None 為全部) 已載入，只下載尚未載入的分片"""
+        with self.lock:
+            if self.has_albums(albums) or self.manifest is None:
+                return
+            wanted = self.known_albums() if albums is None else set(albums)
+            missing = wanted - self.loaded_albums
+            with perf_timer("load_db.albums"), paused_gc():
+                data = load_shards(self.manifest, missing, self.shard_cache)
+                apply_journal_ops(data, self.journal_ops, missing)
+                self.base.update({p["public_id"]: serialize_photo(p) for p in data})
+                apply_journal_ops(data, self.pending_ops, missing)
+                self.repo.extend(data)
+            self.loaded_albums |= missing
+            self.complete = self.loaded_albums >= self.known_albums()
+            self.version += 1
+            self.options_version += 1
+
+    def known_tags(self):
+        """所有用過的標籤 (manifest 摘要與已載入的照片)，供篩選選單使用"""
+        with self.lock:
+            tags = {tag for tag, ids in self.repo.index.by_tag.items() if ids}
+            if self.manifest:
+                for info in self.manifest["shards"].values():
+                    tags.update(info["summary"]["tags"])
+            return tags
+
+    def known_years(self):
+        """所有照片的年份 (manifest 摘要與已載入的照片)，供篩選選單使用"""
+        with self.lock:
+            years = {year for year, ids in self.repo.index.by_year.items() if ids}
+            if self.manifest:
+                for info in self.manifest["shards"].values():
+                    years.update(int(month[:4]) for month in info["summary"]["months"])
+            return years
+
+    def option_lists(self, default_tags=()):
+        """
+        上傳 / 篩選選單用的 {"albums", "tags", "years"} 清單 (標籤以 default_tags 開頭，
+        其餘依名稱排序)。同一個 options_version 只計算一次，呼叫端不可修改回傳的清單。
+        """
+        key = (self.options_version, tuple(default_tags))
+        with self.lock:
+            if self._options_key != key:
+                albums = sorted(self.known_albums())
+                if "未分類" not in albums:
+                    albums.append("未分類")
+                extra_tags = self.known_tags() - set(default_tags)
+                self._options = {
+                    "albums": albums,
+                    "tags": list(default_tags) + sorted(extra_tags),
+                    "years": sorted(self.known_years(), reverse=True),
+                }
+                self._options_key = key
+            return self._options
+
+    def album_summaries(self, albums=None):
+        """
+        各相簿的統計摘要 {相簿: 摘要}。尚未載入、且沒有未壓實異動的相簿直接使用
+        manifest 中預先算好的摘要 (不必下載分片)，其餘取自索引增量維護的彙總。
+        """
+        with self.lock:
+            wanted = self.known_albums() if albums is None else set(albums)
+            shards = self.manifest["shards"] if self.manifest else {}
+            touched = ops_albums(self.journal_ops + self.pending_ops)
+            stale = {
+                album
+                for album in wanted - self.loaded_albums
+                if album not in shards or touched is None or album in touched
+            }
+        if stale and not self.complete:
+            self.ensure_albums(stale)
+
+        with self.lock:
+            summaries = {}
+            for album in wanted:
+                if self.complete or album in self.loaded_albums:
+                    summaries[album] = self.repo.album_stats(album)
+                elif album in shards:
+                    summaries[album] = shards[album]["summary"]
+            return summaries
+
+    def _fetch_head(self, conditional=True):
+        """讀取雲端版本標記，回傳標記是否與目前記錄的不同 (304 視為未變更)"""
+        url, options = cloudinary.utils.cloudinary_url(
+            DB_HEAD_FILENAME, resource_type="raw"
+        )
+        headers = {}
+        if conditional and self.head_etag:
+            headers["If-None-Match"] = self.head_etag
+        try:
+            response = cloud_fetch(url, headers=headers, timeout=5)
+            if response.status_code != 200:
+                return False
+            self.head_etag = response.headers.get("ETag")
+            token = response.json().get("token")
+        except Exception:
+            return False
+        changed = token != self.head_token
+        self.head_token = token
+        return changed
+
+    def _check_remote(self):
+        """以 If-None-Match 向雲端詢問版本標記，僅在其他程序寫入過時才重新載入"""
+        self.checked_at = time.time()
+        if self._fetch_head() or self.reload_failed:
+            self._reload()
+
+    def mark_changed(self):
+        """本程序上傳異動後更新雲端版本標記，通知其他程序重新載入"""
+        with self.lock:
+            self.head_token = uuid.uuid4().hex
+            head = {"token": self.head_token, "ts": time.time()}
+        try:
+            cloud_upload(
+                BytesIO(json.dumps(head).encode("utf-8")),
+                public_id=DB_HEAD_FILENAME,
+                resource_type="raw",
+                overwrite=True,
+                invalidate=True,
+            )
+        except Exception as e:
+            print(f"更新版本標記失敗: {e}")
+
+
+@st.cache_resource
+def get_shared_gallery():
+    return SharedGallery()
+
+
+def compact_db(data):
+    """
+    以樂觀並行控制寫入新快照，並刪除已併入快照的增量紀錄；成功回傳 True。
+    寫入前比對雲端快照版本與增量紀錄，若其他程序已寫入則先三方合併；
+    寫入後重新讀取確認沒有被同時寫入覆蓋，否則退避後重試。
+    被取代的分片與併入快照的增量紀錄不在本次刪除，而是記入 manifest
+    (retired / compacted)，超過 DB_GC_DELAY 秒後才由之後的壓實刪除：
+    讀取確認無法排除同時寫入的舊資料覆蓋本次快照，增量紀錄保留著，
+    被覆蓋時載入端仍會重播這些異動。
+    """
+    shared = get_shared_gallery()
+    # 快照必須包含所有相簿，先補齊尚未載入的分片
+    shared.ensure_albums()
+    writer = uuid.uuid4().hex
+    for attempt in range(SNAPSHOT_WRITE_RETRIES):
+        if attempt:
+            time.sleep(min(2.0, 0.2 * 2**attempt) * (0.5 + random.random()))
+        remote, remote_journal_ids, remote_version, remote_manifest = load_db(
+            shared.shard_cache
+        )
+        if remote is None:
+            # 讀不到雲端狀態就無法合併，放棄這次壓實 (增量紀錄保留，之後再壓實)
+            print("無法讀取雲端資料庫，略過這次快照壓實")
+            return False
+        with shared.lock:
+            ours = list(data)
+            base = shared.base
+            unchanged = remote_version == shared.base_version and set(
+                remote_journal_ids
+            ) <= set(shared.journal_ids)
+        merged = ours if unchanged else merge_photo_lists(base, ours, remote)
+        # 舊 manifest 引用的分片改列為停用、本次併入的增量紀錄列為已壓實 (從現在起算)，
+        # 之前記錄的沿用原本的時間
+        now = time.time()
+        retired, compacted = {}, {}
+        if remote_manifest is not None:
+            retired = {
+                f: ts
+                for f, ts in remote_manifest.get("retired", {}).items()
+                if f not in shared.purged
+            }
+            retired.update(
+                (info["file"], now) for info in remote_manifest["shards"].values()
+            )
+            compacted = {
+                j: ts
+                for j, ts in remote_manifest.get("compacted", {}).items()
+                if j not in shared.purged
+            }
+        compacted.update((j, now) for j in remote_journal_ids)
+        manifest = save_db(merged, remote_version + 1, writer, retired, compacted)
+        if manifest is None:
+            return False
+        try:
+            _, written_by = snapshot_header(fetch_manifest())
+        except Exception as e:
+            # 無法確認寫入結果時不清除任何檔案，留待下次壓實
+            print(f"確認快照寫入失敗: {e}")
+            return False
+        if written_by != writer:
+            print(f"快照寫入衝突，重試中 ({attempt + 1}/{SNAPSHOT_WRITE_RETRIES})")
+            continue
+
+        # 清除壓實 / 停用超過 DB_GC_DELAY 秒的增量紀錄與分片 (期間沒有被舊資料覆蓋，
+        # 也沒有近期的 manifest 引用)；本次才記錄的留給之後的壓實
+        expired = sorted(
+            pid
+            for pid, ts in [*manifest["retired"].items(), *manifest["compacted"].items()]
+            if now - ts >= DB_GC_DELAY
+        )
+        purged = set()
+        try:
+            for i in range(0, len(expired), DELETE_BATCH_SIZE):
+                result = cloud_delete(
+                    expired[i : i + DELETE_BATCH_SIZE], resource_type="raw"
+                )
+                purged.update(
+                    pid
+                    for pid, status in result.get("deleted", {}).items()
+                    if status in ("deleted", "not_found")
+                )
+        except Exception as e:
+            print(f"清除舊增量紀錄與分片失敗: {e}")
+        compacted = set(remote_journal_ids)
+        with shared.lock:
+            shared.journal_ids[:] = [
+                j for j in shared.journal_ids if j not in compacted
+            ]
+            if not shared.journal_ids:
+                shared.journal_ops = []
+            shared.manifest = manifest
+            shared.purged = purged
+            shared.options_version += 1
+            shared.base = {p["public_id"]: serialize_photo(p) for p in merged}
+            shared.base_version = remote_version + 1
+            if not unchanged:
+                # 合併進來的其他程序異動直接套用到共用圖庫，不必整個重新載入
+                apply_journal_ops(merged, shared.pending_ops)
+                shared.repo.replace_all(merged)
+                shared.version += 1
+        return True
+    print("快照寫入衝突重試次數已用盡，保留增量紀錄待下次壓實")
+    return False
+
+
+def read_pending_spool():
+    """讀取本機暫存檔中尚未上傳的異動 (最後一行若寫到一半則略過)"""
+    ops = []
+    try:
+        with open(PENDING_SPOOL_PATH, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    ops.extend(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"讀取未同步異動失敗: {e}")
+    return ops
+
+
+def _append_pending_spool(ops):
+    """先把異動寫入本機暫存檔 (fsync) 再接受，程序中斷也不會遺失"""
+    try:
+        with open(PENDING_SPOOL_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(ops, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception as e:
+        print(f"寫入未同步異動暫存檔失敗: {e}")
+
+
+def _rewrite_pending_spool(ops):
+    """上傳完成後以剩餘的異動改寫暫存檔 (先寫暫存再置換，避免寫到一半)"""
+    try:
+        if not ops:
+            if os.path.exists(PENDING_SPOOL_PATH):
+                os.remove(PENDING_SPOOL_PATH)
+            return
+        tmp_path = f"{PENDING_SPOOL_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(ops, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, PENDING_SPOOL_PATH)
+    except Exception as e:
+        print(f"改寫未同步異動暫存檔失敗: {e}")
+
+
+def schedule_flush(shared, delay=FLUSH_INTERVAL):
+    """若尚未排程，delay 秒後在背景執行緒上傳累積的異動 (需持有 shared.lock)"""
+    if shared.flush_timer is None:
+        shared.flush_timer = threading.Timer(delay, flush_changes)
+        shared.flush_timer.daemon = True
+        shared.flush_timer.start()
+
+
+def record_changes(ops):
+    """
+    記錄異動：立即套用到共用圖庫並寫入本機暫存檔，雲端寫入延後合併，
+    FLUSH_INTERVAL 秒內的多次異動只會上傳一筆增量紀錄。
+    """
+    # 找不到照片的異動 (例如已被刪除) 會是 None，直接略過
+    ops = [op for op in ops if op]
+    if not ops:
+        return
+    shared = get_shared_gallery()
+    with shared.lock:
+        _append_pending_spool(ops)
+        shared.pending_ops.extend(ops)
+        shared.version += 1
+        if any(
+            op["op"] != "update" or SharedGallery.OPTION_FIELDS & op["fields"].keys()
+            for op in ops
+        ):
+            shared.options_version += 1
+        schedule_flush(shared)
+
+
+def flush_changes():
+    """
+    把累積的異動合併成一筆增量紀錄上傳 (計時器到期或手動同步時呼叫)，
+    累積達 JOURNAL_COMPACT_THRESHOLD 筆增量紀錄時才重寫完整快照。
+    成功 (或沒有待上傳的異動) 回傳 True；失敗時保留異動並稍後重試。
+    """
+    shared = get_shared_gallery()
+    with shared.flush_lock:
+        with shared.lock:
+            if shared.flush_timer is not None:
+                shared.flush_timer.cancel()
+                shared.flush_timer = None
+            ops = list(shared.pending_ops)
+        if not ops:
+            return True
+        if not _write_journal_entry(shared, ops):
+            with shared.lock:
+                schedule_flush(shared)
+            return False
+        with shared.lock:
+            del shared.pending_ops[: len(ops)]
+            _rewrite_pending_spool(shared.pending_ops)
+        shared.mark_changed()
+        return True
+
+
+def _write_journal_entry(shared, ops):
+    """上傳一筆增量紀錄，失敗時退回完整快照；兩者皆失敗回傳 False"""
+    journal_id = f"{DB_JOURNAL_PREFIX}{time.time_ns():020d}_{uuid.uuid4().hex[:8]}"
+    entry = {"ts": time.time(), "ops": ops}
+    try:
+        cloud_upload(
+            BytesIO(json.dumps(entry, ensure_ascii=False).encode("utf-8")),
+            public_id=journal_id,
+            resource_type="raw",
+        )
+    except Exception as e:
+        # 增量紀錄寫入失敗時退回完整快照，確保資料不遺失
+        print(f"寫入增量紀錄失敗，改寫完整快照: {e}")
+        return compact_db(shared.repo.photos)
+
+    with shared.lock:
+        shared.journal_ids.append(journal_id)
+        need_compact = len(shared.journal_ids) >= JOURNAL_COMPACT_THRESHOLD
+    if need_compact:
+        compact_db(shared.repo.photos)
+    return True
+
+
+def make_share_token(public_ids, watermark):
+    """分享代碼：照片 ID 與浮水印設定的雜湊，同樣的分享內容會得到同一個代碼"""
+    key = json.dumps([sorted(public_ids), bool(watermark)]).encode("utf-8")
+    return hashlib.sha256(key).hexdigest()[:12]
+
+
+def create_share(photos, watermark):
+    """
+    將分享內容 (照片 ID、所在相簿、浮水印設定) 寫成雲端小檔，連結只需帶代碼。
+    成功回傳分享代碼，失敗回傳 None。
+    """
+    public_ids = [p["public_id"] for p in photos]
+    token = make_share_token(public_ids, watermark)
+    record = {
+        "ids": public_ids,
+        "albums": sorted({p["album"] for p in photos}),
+        "wm": bool(watermark),
+        "ts": time.time(),
+    }
+    try:
+        _upload_raw(
+            json.dumps(record, ensure_ascii=False).encode("utf-8"),
+            f"{DB_SHARE_PREFIX}{token}.json",
+        )
+    except Exception as e:
+        print(f"建立分享連結失敗: {e}")
+        return None
+    return token
+
+
+@st.cache_data(max_entries=SHARE_CACHE_SIZE, show_spinner=False)
+def fetch_share(token):
+    """
+    依分享代碼讀取分享內容 (內容不會變動，快取在伺服器端)。
+    代碼無效或找不到時拋出 LookupError，失敗結果不會被快取。
+    """
+    if len(token) != 12 or not all(c in "0123456789abcdef" for c in token):
+        raise LookupError(f"無效的分享代碼 {token}")
+    record = _fetch_raw_json(f"{DB_SHARE_PREFIX}{token}.json")
+    if record is None:
+        raise LookupError(f"找不到分享代碼 {token}")
+    return record
+
+
+def _delete_image_batch(public_ids):
+    """刪除一批圖片，回傳 {public_id: 狀態}；整批呼叫失敗時每張都記錄錯誤訊息"""
+    try:
+        res = cloud_delete(public_ids, invalidate=True)
+    except Exception as e:
+        print(f"批次刪除圖片失敗 ({len(public_ids)} 張): {e}")
+        return {pid: f"error: {e}" for pid in public_ids}
+    deleted = res.get("deleted", {})
+    return {pid: deleted.get(pid, "unknown") for pid in public_ids}
+
+
+def delete_images_from_cloud(public_ids, on_progress=None):
+    """
+    以 delete_resources 批次刪除圖片 (每批最多 DELETE_BATCH_SIZE 張，多批並行)。
+    回傳 (已刪除的 public_id 集合, {刪除失敗的 public_id: 狀態})；
+    雲端已不存在 (not_found) 的視同刪除成功。
+    """
+    public_ids = sorted(public_ids)
+    batches = [
+        public_ids[i : i + DELETE_BATCH_SIZE]
+        for i in range(0, len(public_ids), DELETE_BATCH_SIZE)
+    ]
+    deleted, failed = set(), {}
+    if not batches:
+        return deleted, failed
+    with ThreadPoolExecutor(max_workers=min(DELETE_CONCURRENCY, len(batches))) as pool:
+        futures = [pool.submit(_delete_image_batch, batch) for batch in batches]
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            for pid, status in future.result().items():
+                if status in ("deleted", "not_found"):
+                    deleted.add(pid)
+                else:
+                    failed[pid] = status
+            if on_progress:
+                on_progress(done_count, len(batches))
+    return deleted, failed
+
+
+class JobQueue:
+    """
+    行程內的背景工作佇列：批次上傳 / 刪除 / 標籤寫入交給工作執行緒處理，
+    不會因為重新整理頁面或連線中斷而中止。工作紀錄存放在行程共用的記憶體中，
+    任何工作階段都能查詢進度與結果；狀態改變時同時寫入 path，
+    重新啟動後還原紀錄 (工作本身無法接續，未完成的標記為失敗)。
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, path=JOB_RECORD_PATH):
+        self.lock = threading.Lock()
+        self.path = path
+        self.jobs = {}  # job_id -> 工作紀錄 (依提交順序)
+        for job in self._read_records():
+            if job["finished_at"] is None:
+                job.update(
+                    status="failed",
+                    error="伺服器重新啟動，工作未完成 (請重新執行)",
+                    finished_at=time.time(),
+                )
+            self.jobs[job["id"]] = job
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="gallery-job"
+        )
+
+    def submit(self, label, func, *args):
+        """
+        在背景執行 func(report, *args)，回傳 job_id。
+        func 以 report(done, total, message) 回報進度，回傳值 (dict) 存為工作結果。
+        """
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            "id": job_id,
+            "label": label,
+            "status": "queued",
+            "done": 0,
+            "total": 0,
+            "message": "",
+            "result": None,
+            "error": None,
+            "submitted_at": time.time(),
+            "finished_at": None,
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            self._prune()
+            self._write_records()
+        self._pool.submit(self._run, job, func, args)
+        return job_id
+
+    def _run(self, job, func, args):
+        def report(done, total, message=""):
+            with self.lock:
+                job.update(done=done, total=total, message=message)
+
+        with self.lock:
+            job["status"] = "running"
+            self._write_records()
+        try:
+            result = func(report, *args)
+        except Exception as e:
+            print(f"背景工作失敗 ({job['label']}): {e}")
+            with self.lock:
+                job.update(status="failed", error=str(e), finished_at=time.time())
+                self._write_records()
+        else:
+            with self.lock:
+                job.update(status="done", result=result, finished_at=time.time())
+                self._write_records()
+
+    def _prune(self):
+        """只保留最近 JOB_HISTORY_LIMIT 筆已結束的工作紀錄"""
+        finished = [j["id"] for j in self.jobs.values() if j["finished_at"]]
+        for job_id in finished[: max(0, len(finished) - JOB_HISTORY_LIMIT)]:
+            del self.jobs[job_id]
+
+    def snapshot(self):
+        """回傳所有工作紀錄的複本 (依提交順序)"""
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def has_active(self):
+        with self.lock:
+            return any(j["finished_at"] is None for j in self.jobs.values())
+
+    def dismiss_finished(self):
+        with self.lock:
+            for job_id in [j["id"] for j in self.jobs.values() if j["finished_at"]]:
+                del self.jobs[job_id]
+            self._write_records()
+
+    def _read_records(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            print(f"讀取工作紀錄失敗: {e}")
+            return []
+
+    def _write_records(self):
+        """以目前的工作紀錄改寫紀錄檔 (先寫暫存再置換，需持有 lock)；進度更新不寫入"""
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(list(self.jobs.values()), f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"寫入工作紀錄失敗: {e}")
+
+
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
+
+
+def run_upload_job(report, items, album):
+    """背景工作：壓縮上傳一批圖片並寫入圖庫"""
+
+    def on_progress(done, total, item, error):
+        report(done, total, item["name"])
+
+    results = upload_files_parallel(items, on_progress=on_progress)
+
+    # 依原始選取順序寫入圖庫，確保結果穩定可預期
+    new_photos = []
+    errors = []
+    for item, res, file_size_bytes, error in results:
+        if error is not None:
+            errors.append(f"{item['name']} 上傳失敗: {error}")
+            continue
+        new_photos.append(
+            {
+                "public_id": res["public_id"],
+                "url": res["secure_url"],
+                "name": item["name"],
+                "date": parse_photo_date(item["name"]),
+                "tags": [],
+                "album": album,
+                "size": file_size_bytes,
+                "eager": eager_ready_transformations(res),
+                "sha256": item["sha256"],
+                "phash": item["phash"],
+            }
+        )
+
+    record_changes(get_shared_gallery().repo.add(new_photos))
+    return {"summary": f"已上傳 {len(new_photos)} 張照片到「{album}」", "errors": errors}
+
+
+def run_delete_job(report, public_ids):
+    """背景工作：批次刪除雲端圖片，只移除確實刪除成功的照片"""
+    repo = get_shared_gallery().repo
+    deleted_ids, failed = delete_images_from_cloud(
+        public_ids, on_progress=lambda done, total: report(done, total, "刪除雲端圖片")
+    )
+    if deleted_ids:
+        record_changes([repo.remove(deleted_ids)])
+    errors = [f"{p['name']} 刪除失敗（{failed[p['public_id']]}）" for p in repo.select(failed)]
+    return {
+        "summary": f"已刪除 {len(deleted_ids)} 張照片",
+        "errors": errors,
+        "retry_ids": sorted(failed),
+    }
+
+
+def run_tag_job(report, public_ids, tags, overwrite):
+    """背景工作：批次加入或覆蓋標籤"""
+    repo = get_shared_gallery().repo
+    ops = []
+    for done, photo in enumerate(repo.select(public_ids), start=1):
+        new_tags = list(tags) if overwrite else list(set(photo.get("tags", []) + tags))
+        ops.append(repo.update(photo["public_id"], tags=new_tags))
+        report(done, len(public_ids), photo["name"])
+    record_changes([op for op in ops if op])
+    verb = "覆蓋" if overwrite else "加入"
+    return {"summary": f"已{verb} {len(ops)} 張照片的標籤", "errors": []}
+
+
+def run_backfill_job(report, public_ids):
+    """背景工作：替舊照片補算 dHash"""
+    repo = get_shared_gallery().repo
+    hashes = backfill_perceptual_hashes(
+        repo.select(public_ids),
+        on_progress=lambda done, total: report(done, total, "下載縮圖計算中"),
+    )
+    ops = [repo.update(pid, phash=h) for pid, h in hashes.items()]
+    record_changes([op for op in ops if op])
+    failed_count = len(public_ids) - len(hashes)
+    return {
+        "summary": f"已補算 {len(hashes)} 張照片的相似度雜湊",
+        "errors": [f"{failed_count} 張照片的縮圖下載失敗"] if failed_count else [],
+    }
+
+
+def run_watermark_job(report, public_ids, layer):
+    """背景工作：請 Cloudinary 預先產生分享照片的浮水印衍生圖 (非同步產生)"""
+    eager = [watermark_transformation(width, layer) for width in WATERMARK_WIDTHS]
+    errors = []
+    with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+        futures = {
+            pool.submit(
+                cloudinary.uploader.explicit,
+                pid,
+                type="upload",
+                eager=eager,
+                eager_async=True,
+            ): pid
+            for pid in public_ids
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(f"{futures[future]} 預先產生失敗（{e}）")
+            report(done, len(public_ids), "預先產生浮水印圖")
+    return {
+        "summary": f"已排入 {len(public_ids) - len(errors)} 張照片的浮水印圖預先產生",
+        "errors": errors,
+    }
+
+
+def run_local_watermark_job(report, public_ids, width):
+    """背景工作：在本機預先合成分享照片的浮水印圖並存入磁碟快取"""
+    photos = get_shared_gallery().repo.select(public_ids)
+    results = render_local_watermarks(
+        photos,
+        width,
+        on_progress=lambda done, total: report(done, total, "合成浮水印圖"),
+    )
+    errors = [f"{p['name']} 合成失敗" for p in photos if results[p["public_id"]] is None]
+    return {
+        "summary": f"已預先合成 {len(photos) - len(errors)} 張照片的浮水印圖",
+        "errors": errors,
+    }
+
+
+def sort_photos(photos, sort_option):
+    """依相簿瀏覽的排序選項原地排序照片清單並回傳"""
+    if sort_option == "日期 (舊→新)":
+        photos.sort(key=lambda x: x["date"])
+    elif sort_option == "日期 (新→舊)":
+        photos.sort(key=lambda x: x["date"], reverse=True)
+    elif sort_option == "檔名 (A→Z)":
+        photos.sort(key=lambda x: x["name"])
+    elif sort_option == "檔名 (Z→A)":
+        photos.sort(key=lambda x: x["name"], reverse=True)
+    elif sort_option == "標籤 (A→Z)":
+        photos.sort(key=lambda x: x["tags"][0] if x["tags"] else "zzzz")
+    return photos
+
+
+def month_year_table(month_counts):
+    """由 {"YYYY-MM": 張數} 組出「月份 (1~12) x 年份 (新→舊)」的張數表"""
+    years = sorted({int(month[:4]) for month in month_counts}, reverse=True)
+    table = pd.DataFrame(0, index=pd.RangeIndex(1, 13, name="Month"), columns=years)
+    for month, count in month_counts.items():
+        table.at[int(month[5:]), int(month[:4])] = count
+    return table
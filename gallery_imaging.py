@@ -0,0 +1,144 @@
+"""
+圖片壓縮 (上傳前的縮圖與 JPEG 重新編碼)。
+
+獨立成只依賴 Pillow 的模組，讓壓縮程序池的子程序能以模組名稱匯入工作函數：
+Streamlit 每次執行都會以新的模組取代 __main__，定義在 app.py 的函式無法 pickle 給子程序。
+程序池本身也放在這裡，整個伺服器程序共用一個長駐的程序池。
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+import multiprocessing
+import os
+import site
+import sys
+import threading
+import time
+import types
+
+from PIL import ExifTags, Image, ImageOps
+
+MAX_IMAGE_WIDTH = 1920
+
+
+def compress_image(image_file):
+    """
+    壓縮成寬度最多 MAX_IMAGE_WIDTH 的 JPEG。
+    JPEG 先以 draft() 在解碼階段直接縮小 (DCT 1/2、1/4、1/8)，其他格式以 reduce() 先粗縮，
+    最後才用 LANCZOS 精修並依 EXIF 方向轉正，避免解出並旋轉整張全解析度點陣圖。
+    """
+    try:
+        img = Image.open(image_file)
+        try:
+            orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+        except Exception:
+            orientation = 1
+        # 方向 5~8 代表需轉 90/270 度，轉正後的寬度其實是原始高度
+        swap_axes = orientation in (5, 6, 7, 8)
+        src_w, src_h = img.size
+        display_w = src_h if swap_axes else src_w
+
+        target = None
+        if display_w > MAX_IMAGE_WIDTH:
+            scale = MAX_IMAGE_WIDTH / display_w
+            if swap_axes:
+                target = (max(1, int(src_w * scale)), MAX_IMAGE_WIDTH)
+            else:
+                target = (MAX_IMAGE_WIDTH, max(1, int(src_h * scale)))
+            # draft 只會縮到不小於 target 的尺寸，之後再以 LANCZOS 精修到目標大小
+            img.draft(img.mode, target)
+
+        if img.mode not in ("RGB", "L", "CMYK"):
+            img = img.convert("RGB")
+
+        if target:
+            img = img.resize(target, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+        img = ImageOps.exif_transpose(img)
+
+        output_buffer = BytesIO()
+        img.save(output_buffer, format="JPEG", quality=80, optimize=True)
+        output_buffer.seek(0)
+        return output_buffer
+    except Exception as e:
+        print(f"壓縮失敗: {e}")
+        image_file.seek(0)
+        return image_file
+
+
+def compress_image_bytes(data):
+    """
+    程序池工作函數：輸入原始位元組，回傳 (壓縮後的 JPEG 位元組, 壓縮耗時秒數)。
+    子程序內記錄的統計不會回到主程序，因此耗時交由呼叫端記錄。
+    """
+    started = time.perf_counter()
+    output = compress_image(BytesIO(data)).getvalue()
+    return output, time.perf_counter() - started
+
+
+# --- 長駐壓縮程序池 ---
+# 不使用 fork：在多執行緒的 Streamlit / Tornado 伺服器中 fork 可能死結，
+# 而且每個子程序都會複製一份記憶體中的整個圖庫
+_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+_base_context = multiprocessing.get_context(_START_METHOD)
+_start_lock = threading.Lock()
+_pool_lock = threading.Lock()
+_pool = None
+
+
+@contextmanager
+def _plain_main_module():
+    """
+    啟動子程序期間暫時以空模組取代 __main__。Streamlit 把 app.py 裝成 __main__，
+    multiprocessing 會在 spawn / forkserver 的子程序中重新執行 __main__ 的檔案 (也就是整個 app.py)。
+    """
+    with _start_lock:
+        current = sys.modules.get("__main__")
+        placeholder = types.ModuleType("__main__")
+        sys.modules["__main__"] = placeholder
+        try:
+            yield
+        finally:
+            # 期間若有其他 session 開始執行並換上自己的 __main__，保留對方的
+            if sys.modules.get("__main__") is placeholder:
+                sys.modules["__main__"] = current
+
+
+class _WorkerProcess(_base_context.Process):
+    def start(self):
+        with _plain_main_module():
+            super().start()
+
+
+class _WorkerContext(type(_base_context)):
+    Process = _WorkerProcess
+
+
+def get_compress_pool(max_workers):
+    """
+    取得長駐的壓縮程序池 (第一次使用時建立，子程序在需要時才啟動並持續重用)。
+    子程序啟動時先把本模組所在目錄加入 sys.path，才能以名稱匯入 compress_image_bytes。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=_WorkerContext(),
+                initializer=site.addsitedir,
+                initargs=(_MODULE_DIR,),
+            )
+        return _pool
+
+
+def discard_compress_pool(pool):
+    """程序池損壞 (例如子程序被系統終止) 時捨棄，下次使用時重新建立"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,55 @@
+"""
+測試共用設定：Cloudinary 與 requests 以 benchmark.py 的 OfflineCloud 取代，
+直接匯入 gallery_core，不會連線到雲端也不必執行頁面。
+"""
+
+import functools
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def core():
+    return benchmark.load_core()
+
+
+@pytest.fixture
+def cloud(core, monkeypatch):
+    offline = benchmark.OfflineCloud()
+    offline.install(functools.partial(monkeypatch.setattr, raising=False))
+    return offline
+
+
+@pytest.fixture
+def photos(core):
+    return benchmark.synthetic_gallery(core, 30)
+
+
+@pytest.fixture
+def galleries(core, cloud, monkeypatch, tmp_path):
+    """
+    建立模擬不同伺服器程序的 SharedGallery：呼叫 galleries() 取得新的程序，
+    galleries.use(g) 切換 get_shared_gallery 回傳的程序 (壓實與上傳異動以它為準)。
+    """
+    current = {}
+
+    def new():
+        gallery = core.SharedGallery()
+        current["gallery"] = gallery
+        return gallery
+
+    def use(gallery):
+        current["gallery"] = gallery
+        return gallery
+
+    new.use = use
+    monkeypatch.setattr(core, "get_shared_gallery", lambda: current["gallery"])
+    monkeypatch.setattr(core, "PENDING_SPOOL_PATH", str(tmp_path / "pending.jsonl"))
+    monkeypatch.setattr(core.time, "sleep", lambda seconds: None)
+    return new
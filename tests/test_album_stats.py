@@ -0,0 +1,48 @@
+"""相簿統計彙總 (AlbumStats) 增量更新與重新掃描的結果比對"""
+
+import random
+
+import benchmark
+
+
+def test_random_updates_match_rescan(core):
+    photos = benchmark.synthetic_gallery(core, 300, seed=20)
+    index = core.GalleryIndex(photos[:150])
+    live = {p["public_id"]: p for p in photos[:150]}
+    pending = photos[150:]
+    rng = random.Random(20)
+    all_tags = sorted({t for p in photos for t in p["tags"]})
+
+    for step in range(600):
+        action = rng.random()
+        if action < 0.3 and pending:
+            photo = pending.pop()
+            index.add(photo)
+            live[photo["public_id"]] = photo
+        elif action < 0.5 and live:
+            pid = rng.choice(sorted(live))
+            index.remove(pid)
+            del live[pid]
+        elif live:
+            photo = live[rng.choice(sorted(live))]
+            # 標籤可能重複，統計時每張照片的同一標籤只算一次
+            photo["tags"] = rng.choices(all_tags, k=rng.randint(0, 3))
+            photo["album"] = rng.choice(["相簿00", "相簿01", "未分類"])
+            photo["size"] = rng.randint(0, 10**7)
+            index.reindex(photo)
+
+        if step % 50 == 0:
+            _assert_matches(core, index, live.values())
+    _assert_matches(core, index, live.values())
+
+
+def _assert_matches(core, index, photos):
+    photos = list(photos)
+    expected = {
+        album: core.album_summary([p for p in photos if p["album"] == album])
+        for album in {p["album"] for p in photos}
+    }
+    assert {album: stats.summary() for album, stats in index.stats.items()} == expected
+    assert core.combine_summaries(s.summary() for s in index.stats.values()) == (
+        core.album_summary(photos)
+    )
@@ -0,0 +1,151 @@
+"""三方合併與快照壓實 (merge_photo_lists / compact_db) 的離線測試"""
+
+import time
+
+import benchmark
+
+
+def _by_id(photos):
+    return {p["public_id"]: p for p in photos}
+
+
+def _edited(photo, **fields):
+    return {**photo, **fields}
+
+
+# --- merge_photo_lists ---
+def test_merge_delete_wins_over_edit(core, photos):
+    base = {p["public_id"]: core.serialize_photo(p) for p in photos}
+    target = photos[0]["public_id"]
+    deleted = photos[1:]
+    edited = [_edited(photos[0], name="edited.jpg")] + photos[1:]
+
+    # 任一方刪除的照片 (雲端圖片已不存在) 都不能因另一方的修改而復活
+    assert target not in _by_id(core.merge_photo_lists(base, deleted, edited))
+    assert target not in _by_id(core.merge_photo_lists(base, edited, deleted))
+    assert len(core.merge_photo_lists(base, deleted, edited)) == len(photos) - 1
+
+
+def test_merge_keeps_additions_from_both_sides(core, photos):
+    base = {p["public_id"]: core.serialize_photo(p) for p in photos[:-2]}
+    ours = photos[:-1]
+    theirs = photos[:-2] + photos[-1:]
+
+    merged = _by_id(core.merge_photo_lists(base, ours, theirs))
+    assert set(merged) == {p["public_id"] for p in photos}
+
+
+def test_merge_stale_remote_does_not_revert_edits(core, photos):
+    base = {p["public_id"]: core.serialize_photo(p) for p in photos}
+    ours = [_edited(photos[0], name="ours.jpg")] + photos[1:]
+    theirs = [photos[0], _edited(photos[1], tags=["其他程序"])] + photos[2:]
+
+    merged = _by_id(core.merge_photo_lists(base, ours, theirs))
+    # 雲端沒改的欄位採用本程序的修改，雙方各自修改的欄位都保留
+    assert merged[photos[0]["public_id"]]["name"] == "ours.jpg"
+    assert merged[photos[1]["public_id"]]["tags"] == ["其他程序"]
+    untouched = photos[2]["public_id"]
+    assert core.serialize_photo(merged[untouched]) == base[untouched]
+
+
+# --- compact_db ---
+def _load(core, galleries):
+    """以全新的程序載入完整圖庫"""
+    gallery = galleries()
+    gallery.sync()
+    gallery.ensure_albums()
+    return gallery
+
+
+def _live_files(manifest):
+    return {info["file"] for info in manifest["shards"].values()}
+
+
+def _journal_ids(cloud, core):
+    return [pid for pid in cloud.raw if pid.startswith(core.DB_JOURNAL_PREFIX)]
+
+
+def test_compact_aborts_when_remote_unreadable(core, cloud, galleries, photos, monkeypatch):
+    core.save_db(photos, 1, "seed")
+    gallery = _load(core, galleries)
+    target = photos[0]["public_id"]
+    core.record_changes([gallery.repo.update(target, name="edited.jpg")])
+    assert core.flush_changes()
+
+    online_get = cloud.get
+
+    def unavailable(url, **kwargs):
+        if core.DB_MANIFEST_FILENAME in url:
+            return benchmark._Response(503)
+        return online_get(url, **kwargs)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(core.requests, "get", unavailable)
+        assert core.compact_db(gallery.repo.photos) is False
+
+    reloaded = _load(core, galleries)
+    assert len(reloaded.repo.photos) == len(photos)
+    assert reloaded.repo.by_id[target]["name"] == "edited.jpg"
+
+
+def test_stale_writer_does_not_lose_compacted_journal(core, cloud, galleries, photos, monkeypatch):
+    core.save_db(photos, 1, "seed")
+    writer = _load(core, galleries)
+    stale = _load(core, galleries)
+    # stale 程序在 writer 的異動與壓實之前讀到的雲端狀態
+    stale_remote = core.load_db()
+
+    galleries.use(writer)
+    target = photos[0]["public_id"]
+    core.record_changes([writer.repo.update(target, name="edited.jpg")])
+    assert core.flush_changes()
+    assert core.compact_db(writer.repo.photos)
+    (journal_id,) = _journal_ids(cloud, core)
+    assert journal_id in core.fetch_manifest()["compacted"]
+
+    # stale 程序以壓實前讀到的狀態寫入快照，覆蓋 writer 剛寫入的 manifest
+    galleries.use(stale)
+    with monkeypatch.context() as patch:
+        patch.setattr(core, "load_db", lambda shard_cache=None: stale_remote)
+        assert core.compact_db(stale.repo.photos)
+
+    # 增量紀錄仍在雲端、且不在新 manifest 的已壓實清單中，載入時會重播
+    assert journal_id in cloud.raw
+    assert journal_id not in core.fetch_manifest()["compacted"]
+    reloaded = _load(core, galleries)
+    assert reloaded.repo.by_id[target]["name"] == "edited.jpg"
+
+
+def test_compaction_collects_garbage_only_after_delay(core, cloud, galleries, photos, monkeypatch):
+    core.save_db(photos, 1, "seed")
+    gallery = _load(core, galleries)
+    target = photos[0]
+    original_files = _live_files(core.fetch_manifest())
+
+    core.record_changes([gallery.repo.update(target["public_id"], name="edited.jpg")])
+    assert core.flush_changes()
+    assert core.compact_db(gallery.repo.photos)
+    manifest = core.fetch_manifest()
+    # 被取代的分片與增量紀錄在同一次壓實中都不會刪除
+    assert original_files <= cloud.raw.keys()
+    assert set(_journal_ids(cloud, core)) == set(manifest["compacted"])
+
+    # 改回原本的檔名：新快照的分片與先前停用的分片內容相同
+    core.record_changes([gallery.repo.update(target["public_id"], name=target["name"])])
+    assert core.flush_changes()
+    real_time = time.time
+    with monkeypatch.context() as patch:
+        patch.setattr(core.time, "time", lambda: real_time() + core.DB_GC_DELAY + 1)
+        assert core.compact_db(gallery.repo.photos)
+    manifest = core.fetch_manifest()
+    assert _live_files(manifest) == original_files
+    assert not set(manifest["retired"]) & original_files
+    assert _live_files(manifest) <= cloud.raw.keys()
+    # 壓實超過 DB_GC_DELAY 的增量紀錄已刪除，只剩本次併入的
+    assert set(_journal_ids(cloud, core)) == {
+        j for j, ts in manifest["compacted"].items() if ts > real_time()
+    }
+
+    reloaded = _load(core, galleries)
+    assert reloaded.repo.by_id[target["public_id"]]["name"] == target["name"]
+    assert len(reloaded.repo.photos) == len(photos)
@@ -0,0 +1,67 @@
+"""倒排索引 (GalleryIndex.query) 與逐張掃描的結果比對"""
+
+import random
+
+import benchmark
+
+
+def _scan(photos, album=None, year=None, months=None, include_tags=(), exclude_tags=(), untagged_only=False):
+    """不經索引、逐張比對條件的參考實作"""
+    result = set()
+    for p in photos:
+        tags = set(p["tags"])
+        if album is not None and p["album"] != album:
+            continue
+        if year is not None and p["date"].year != year:
+            continue
+        if months and p["date"].month not in months:
+            continue
+        if untagged_only:
+            if tags:
+                continue
+        elif not set(include_tags) <= tags or tags & set(exclude_tags):
+            continue
+        result.add(p["public_id"])
+    return result
+
+
+def _random_queries(photos, rng, n):
+    albums = sorted({p["album"] for p in photos}) + ["不存在的相簿"]
+    years = sorted({p["date"].year for p in photos})
+    tags = sorted({t for p in photos for t in p["tags"]})
+    for _ in range(n):
+        yield {
+            "album": rng.choice([None, *albums]),
+            "year": rng.choice([None, *years]),
+            "months": rng.choice([None, [], list(range(1, 13)), rng.sample(range(1, 13), rng.randint(1, 4))]),
+            "include_tags": rng.sample(tags, rng.choice([0, 0, 1, 2])),
+            "exclude_tags": rng.sample(tags, rng.choice([0, 0, 1])),
+            "untagged_only": rng.random() < 0.15,
+        }
+
+
+def test_query_matches_full_scan(core, photos):
+    index = core.GalleryIndex(photos)
+    rng = random.Random(4)
+    for filters in _random_queries(photos, rng, 300):
+        assert index.query(**filters) == _scan(photos, **filters), filters
+
+
+def test_query_after_edits_and_removals(core):
+    photos = benchmark.synthetic_gallery(core, 200, seed=1)
+    index = core.GalleryIndex(photos)
+    rng = random.Random(5)
+    all_tags = sorted({t for p in photos for t in p["tags"]})
+    for photo in rng.sample(photos, 40):
+        # 照片被原地修改後重新索引
+        photo["tags"] = rng.sample(all_tags, rng.randint(0, 3))
+        photo["album"] = rng.choice(["相簿00", "未分類", "新相簿"])
+        index.reindex(photo)
+    removed = rng.sample(photos, 30)
+    for photo in removed:
+        index.remove(photo["public_id"])
+    remaining = [p for p in photos if p not in removed]
+
+    assert index.all_ids == {p["public_id"] for p in remaining}
+    for filters in _random_queries(remaining, rng, 300):
+        assert index.query(**filters) == _scan(remaining, **filters), filters
@@ -0,0 +1,56 @@
+"""dHash 相似度索引 (HammingIndex.nearest) 與逐張計算的結果比對"""
+
+import random
+
+
+def hamming_distance(a, b):
+    """兩個十六進位 dHash 的漢明距離 (逐張比對的參考實作)"""
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+def _brute_force(hashes, phash, k, max_distance, exclude=()):
+    matches = sorted(
+        (hamming_distance(phash, h), pid)
+        for pid, h in hashes.items()
+        if pid not in exclude and hamming_distance(phash, h) <= max_distance
+    )
+    return matches[:k]
+
+
+def _near(rng, phash, flips):
+    value = int(phash, 16)
+    for bit in rng.sample(range(64), flips):
+        value ^= 1 << bit
+    return f"{value:016x}"
+
+
+def test_nearest_matches_brute_force_after_removals(core):
+    rng = random.Random(12)
+    seeds = [f"{rng.getrandbits(64):016x}" for _ in range(20)]
+    # 每個種子附近放一群相似的雜湊，讓距離上限內有足夠的候選與同距離的情況
+    hashes = {
+        f"p{i:04d}": _near(rng, rng.choice(seeds), rng.randint(0, 12)) for i in range(1500)
+    }
+    index = core.HammingIndex()
+    items = list(hashes.items())
+    index.extend((h, pid) for pid, h in items[:1000])
+    for pid, h in items[1000:]:
+        index.add(h, pid)
+
+    for pid in rng.sample(sorted(hashes), 600):
+        index.remove(pid)
+        del hashes[pid]
+    # 已存在的照片重新計算 dHash 後覆寫
+    for pid in rng.sample(sorted(hashes), 100):
+        hashes[pid] = _near(rng, rng.choice(seeds), rng.randint(0, 12))
+        index.add(hashes[pid], pid)
+
+    assert len(index) == len(hashes)
+    for _ in range(200):
+        phash = _near(rng, rng.choice(seeds), rng.randint(0, 16))
+        k = rng.choice([1, 5, 12])
+        max_distance = rng.choice([4, 10, 20, 64])
+        exclude = set(rng.sample(sorted(hashes), 3))
+        assert index.nearest(phash, k=k, max_distance=max_distance, exclude=exclude) == (
+            _brute_force(hashes, phash, k, max_distance, exclude)
+        )
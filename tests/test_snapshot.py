@@ -0,0 +1,29 @@
+"""v3 欄式快照 (encode_snapshot / decode_snapshot) 的來回轉換"""
+
+import gzip
+import json
+
+
+def _round_trip(core, photos):
+    return core.decode_snapshot(json.loads(gzip.decompress(core.encode_snapshot(photos, 7, "w"))))
+
+
+def test_round_trip_is_lossless(core, photos):
+    photos[0]["url"] = "https://example.com/elsewhere/photo.jpg"
+    photos[1]["url"] = photos[1]["url"].replace("/upload/", "/upload/c_fill,w_10/")
+    photos[2].update(tags=[], album="未分類", eager=[], phash=None, sha256=None)
+    photos[3]["url"] = photos[3]["url"][: -len(".jpg")] + ".png"
+
+    assert _round_trip(core, photos) == photos
+
+
+def test_header_and_deterministic_bytes(core, photos):
+    encoded = core.encode_snapshot(photos, 7, "w")
+    snapshot = json.loads(gzip.decompress(encoded))
+    assert (snapshot["format"], snapshot["version"], snapshot["writer"]) == (3, 7, "w")
+    # 相同內容必須產生相同位元組 (分片以內容雜湊命名)
+    assert core.encode_snapshot(photos, 7, "w") == encoded
+
+
+def test_empty_snapshot(core):
+    assert _round_trip(core, []) == []